@@ -0,0 +1,230 @@
+from whoosh.idsets import DocIdSet
+import numpy as np
+
+# number of set bits of every byte value
+_POPCOUNT = np.array([bin(b).count('1') for b in range(256)], dtype=np.int64)
+
+
+def _pack(mask: np.ndarray) -> np.ndarray:
+    """64-bit words of a boolean mask; bit n of the mask is bit (n % 64) of word (n // 64)"""
+    padded = np.zeros(-(-len(mask) // 64) * 64, dtype=bool)
+    padded[:len(mask)] = mask
+    # packbits fills a byte from its highest bit, so every group of 8 is reversed first
+    return np.packbits(padded.reshape(-1, 8)[:, ::-1]).view('<u8')
+
+
+def _unpack(words: np.ndarray, size: int) -> np.ndarray:
+    return np.unpackbits(words.view(np.uint8)).reshape(-1, 8)[:, ::-1].ravel()[:size].astype(bool)
+
+
+class DocnumBitmap(DocIdSet):
+    """Set of docnums kept as a dense bitmap over the docnum space [0, size) of an index.
+    It costs size/8 bytes whatever the number of members, union/intersection/difference are word-wise
+    operations and, being a whoosh DocIdSet, it can be given to a searcher as a filter as it is."""
+
+    def __init__(self, size: int, docnums=None):
+        self.size = size
+        self._words = np.zeros(-(-size // 64), dtype='<u8')
+        self._count = 0
+        if docnums is not None:
+            self.update(docnums)
+
+    @classmethod
+    def full(cls, size: int):
+        bitmap = cls(size)
+        bitmap._words = _pack(np.ones(size, dtype=bool))
+        bitmap._count = size
+        return bitmap
+
+    @classmethod
+    def from_mask(cls, mask: np.ndarray):
+        bitmap = cls(len(mask))
+        bitmap._words = _pack(mask)
+        bitmap._count = int(np.count_nonzero(mask))
+        return bitmap
+
+    @classmethod
+    def from_words(cls, size: int, words: np.ndarray):
+        """the bitmap of words as given by words(), e.g. after saving them"""
+        if len(words) != -(-size // 64):
+            raise ValueError('{} words do not cover {} docnums'.format(len(words), size))
+        bitmap = cls(size)
+        bitmap._words = np.array(words, dtype='<u8')
+        bitmap._count = int(_POPCOUNT[bitmap._words.view(np.uint8)].sum())
+        return bitmap
+
+    def _from_words(self, words: np.ndarray):
+        bitmap = DocnumBitmap(self.size)
+        bitmap._words = words
+        bitmap._count = int(_POPCOUNT[words.view(np.uint8)].sum())
+        return bitmap
+
+    def _other_words(self, other) -> np.ndarray:
+        if isinstance(other, DocnumBitmap):
+            if other.size != self.size:
+                raise ValueError('Bitmaps of different sizes ({} and {})'.format(self.size, other.size))
+            return other._words
+        return DocnumBitmap(self.size, other)._words
+
+    def words(self) -> np.ndarray:
+        """the 64-bit words of the bitmap; bit n is bit (n % 64) of word (n // 64)"""
+        return self._words
+
+    def mask(self) -> np.ndarray:
+        """boolean mask of the members over [0, size)"""
+        return _unpack(self._words, self.size)
+
+    def to_array(self) -> np.ndarray:
+        """sorted docnums of the members"""
+        return np.flatnonzero(self.mask())
+
+    def contains(self, docnums) -> np.ndarray:
+        """boolean array telling which of the docnums are members"""
+        docnums = np.asarray(docnums, dtype=np.int64)
+        inside = (docnums >= 0) & (docnums < self.size)
+        found = np.zeros(len(docnums), dtype=bool)
+        dns = docnums[inside]
+        found[inside] = (self._words[dns >> 6] >> (dns & 63).astype('<u8')) & 1 == 1
+        return found
+
+    def __len__(self):
+        return self._count
+
+    def __bool__(self):
+        return self._count > 0
+
+    __nonzero__ = __bool__
+
+    def __contains__(self, docnum):
+        docnum = int(docnum)
+        if docnum < 0 or docnum >= self.size:
+            return False
+        return (int(self._words[docnum >> 6]) >> (docnum & 63)) & 1 == 1
+
+    def __iter__(self):
+        """docnums in increasing order, read word by word from the bitmap"""
+        words = self._words
+        for wi in np.flatnonzero(words).tolist():
+            word = int(words[wi])
+            base = wi << 6
+            while word:
+                low = word & -word
+                yield base + low.bit_length() - 1
+                word ^= low
+
+    def __eq__(self, other):
+        if isinstance(other, DocnumBitmap):
+            return self.size == other.size and np.array_equal(self._words, other._words)
+        return len(self) == len(other) and all(dn in self for dn in other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '{}(size={}, members={})'.format(self.__class__.__name__, self.size, self._count)
+
+    def copy(self):
+        bitmap = DocnumBitmap(self.size)
+        bitmap._words = self._words.copy()
+        bitmap._count = self._count
+        return bitmap
+
+    def add(self, docnum):
+        # numpy integers would overflow or wrap in the shifts
+        docnum = int(docnum)
+        if docnum not in self:
+            self._words[docnum >> 6] |= np.uint64(1 << (docnum & 63))
+            self._count += 1
+
+    def discard(self, docnum):
+        docnum = int(docnum)
+        if docnum in self:
+            self._words[docnum >> 6] ^= np.uint64(1 << (docnum & 63))
+            self._count -= 1
+
+    def update(self, docnums):
+        if isinstance(docnums, DocnumBitmap):
+            self._words |= self._other_words(docnums)
+            self._count = int(_POPCOUNT[self._words.view(np.uint8)].sum())
+            return
+        docnums = np.unique(np.fromiter(docnums, dtype=np.int64) if not isinstance(docnums, np.ndarray)
+                            else docnums.astype(np.int64))
+        if len(docnums) == 0:
+            return
+        if docnums[0] < 0 or docnums[-1] >= self.size:
+            raise IndexError('docnum out of the range [0, {})'.format(self.size))
+        docnums = docnums[~self.contains(docnums)]
+        np.bitwise_or.at(self._words, docnums >> 6, np.left_shift(np.uint64(1), (docnums & 63).astype('<u8')))
+        self._count += len(docnums)
+
+    def intersection_update(self, other):
+        self._words &= self._other_words(other)
+        self._count = int(_POPCOUNT[self._words.view(np.uint8)].sum())
+
+    def difference_update(self, other):
+        if isinstance(other, np.ndarray):
+            # only the words of the docnums are touched
+            docnums = np.unique(other.astype(np.int64))
+            docnums = docnums[self.contains(docnums)]
+            np.bitwise_and.at(self._words, docnums >> 6,
+                              ~np.left_shift(np.uint64(1), (docnums & 63).astype('<u8')))
+            self._count -= len(docnums)
+            return
+        self._words &= ~self._other_words(other)
+        self._count = int(_POPCOUNT[self._words.view(np.uint8)].sum())
+
+    def invert_update(self, size):
+        if size != self.size:
+            raise ValueError('Bitmap of {} docnums cannot be inverted over {}'.format(self.size, size))
+        self._words = _pack(~self.mask())
+        self._count = self.size - self._count
+
+    def union(self, other):
+        return self._from_words(self._words | self._other_words(other))
+
+    def intersection(self, other):
+        return self._from_words(self._words & self._other_words(other))
+
+    def difference(self, other):
+        return self._from_words(self._words & ~self._other_words(other))
+
+    def isdisjoint(self, other):
+        return not (self._words & self._other_words(other)).any()
+
+    def first(self):
+        return self.after(-1)
+
+    def last(self):
+        return self.before(self.size)
+
+    def after(self, i):
+        """the lowest member greater than i, or None"""
+        start = max(int(i) + 1, 0)
+        if start >= self.size:
+            return None
+        wi = start >> 6
+        # the bits of the first word below start are masked out
+        word = int(self._words[wi]) >> (start & 63) << (start & 63)
+        if word == 0:
+            nonzero = np.flatnonzero(self._words[wi + 1:])
+            if len(nonzero) == 0:
+                return None
+            wi += 1 + int(nonzero[0])
+            word = int(self._words[wi])
+        return (wi << 6) + (word & -word).bit_length() - 1
+
+    def before(self, i):
+        """the highest member less than i, or None"""
+        end = min(int(i), self.size) - 1
+        if end < 0:
+            return None
+        wi = end >> 6
+        # the bits of the last word above end are masked out
+        word = int(self._words[wi]) & ((1 << ((end & 63) + 1)) - 1)
+        if word == 0:
+            nonzero = np.flatnonzero(self._words[:wi])
+            if len(nonzero) == 0:
+                return None
+            wi = int(nonzero[-1])
+            word = int(self._words[wi])
+        return (wi << 6) + word.bit_length() - 1
@@ -1,8 +1,17 @@
 from whoosh.index import create_in, exists_in
 from whoosh.fields import *
+from whoosh.index import open_dir
 from traverse import access
+from partition import IndexVirtualPartition
+from bitmap import DocnumBitmap
 from codecs import open
 import logging, config
+import titlecount
+import forward
+import multiprocessing
+import hashlib
+import shutil
+import json
 import sys, time, os
 
 LOGGER = logging.getLogger()
@@ -15,7 +24,7 @@ schema = Schema(title=TEXT(stored=True, vector=True, analyzer=analysis.StandardA
 
 
 def build_index_wiki13(dir_path: str, save_path: str, count_path: str):
-    wiki13_title_count = config.build_wiki13_title_count(count_path)
+    wiki13_title_count = titlecount.open_table(count_path)
     if not os.path.exists(save_path):
         os.mkdir(save_path)
     if not exists_in(save_path):
@@ -34,26 +43,163 @@ def build_index_wiki13(dir_path: str, save_path: str, count_path: str):
         fc +=1
         if fc%1000 == 0:
             print(fc, dpath)
-        did = config.get_article_id_from_file_name(dname)
-        with open(dpath, 'r', encoding='utf-8') as fo:
-            dcont = fo.read()
-        try:
-            if did not in wiki13_title_count:
-                raise LookupError('Filename \'{}\' not in title-count list'.format(did))
-            writer.add_document(title= wiki13_title_count[did]['title'], articleID=did,
-                                body=dcont, count=wiki13_title_count[did]['count'], xpath=dpath)
-        except Exception as e:
-            LOGGER.error(dpath + '  ' + str(e) + '\n')
+        _add_file(writer, wiki13_title_count, dname, dpath)
 
     writer.commit()
+    forward.export(ix)
     return
 
 
+def _add_file(writer, wiki13_title_count, dname: str, dpath: str):
+    did = config.get_article_id_from_file_name(dname)
+    with open(dpath, 'r', encoding='utf-8') as fo:
+        dcont = fo.read()
+    try:
+        if did not in wiki13_title_count:
+            raise LookupError('Filename \'{}\' not in title-count list'.format(did))
+        writer.add_document(title= wiki13_title_count[did]['title'], articleID=did,
+                            body=dcont, count=wiki13_title_count[did]['count'], xpath=dpath)
+    except Exception as e:
+        LOGGER.error(dpath + '  ' + str(e) + '\n')
+
+
+def _build_shard(task):
+    shard, files, shard_path, count_path = task
+    st = time.time()
+    wiki13_title_count = titlecount.open_table(count_path)
+    if os.path.exists(shard_path):
+        shutil.rmtree(shard_path)  # left over from an interrupted run
+    os.makedirs(shard_path)
+    ix = create_in(shard_path, schema)
+    writer = ix.writer(limitmb=config.BUILD_limitmb)
+    for dname, dpath in files:
+        _add_file(writer, wiki13_title_count, dname, dpath)
+    writer.commit()
+    return shard, len(files), time.time() - st
+
+
+def build_index_wiki13_sharded(dir_path: str, save_path: str, count_path: str, shards: int=config.BUILD_procs):
+    """Builds the same index as build_index_wiki13 with one process per shard of the (sorted) file list.
+    Each shard is indexed into its own sub-index under save_path/_shards and they are merged at the end.
+    Finished shards are recorded, so running it again on the same save_path resumes after a crash."""
+    if exists_in(save_path):
+        save_path = save_path + '_{}'.format(time.strftime('%m%d_%H%M'))
+    shards_path = os.path.join(save_path, '_shards')
+    if not os.path.exists(shards_path):
+        os.makedirs(shards_path)
+    titlecount.open_table(count_path)  # compiled once here rather than by every shard
+    files = sorted(access(dir_path), key=lambda f: f[1])
+    # the files themselves, not only their number, have to be the same to resume
+    files_hash = hashlib.sha1('\n'.join(f[1] for f in files).encode('utf-8')).hexdigest()
+    plan = {'dir_path': dir_path, 'shards': shards, 'files': len(files), 'files_sha1': files_hash}
+    plan_path = os.path.join(shards_path, 'plan.json')
+    if os.path.exists(plan_path):
+        with open(plan_path, 'r') as fo:
+            if json.load(fo) != plan:
+                raise ValueError('{} was started with another plan; remove it to start over'.format(save_path))
+    else:
+        with open(plan_path, 'w') as fw:
+            json.dump(plan, fw)
+    done_path = os.path.join(shards_path, 'done.log')
+    done = set()
+    if os.path.exists(done_path):
+        with open(done_path, 'r') as fo:
+            done = set(int(l) for l in fo if l.strip() != '')
+    shard_size = (len(files) + shards - 1) // shards
+    shard_paths = [os.path.join(shards_path, 'shard_{}'.format(i)) for i in range(shards)]
+    tasks = [(i, files[i * shard_size:(i + 1) * shard_size], shard_paths[i], count_path)
+             for i in range(shards) if i not in done]
+    LOGGER.info('Building {} of {} shards of {} files in {}'.format(len(tasks), shards, len(files), save_path))
+    print('Building {} of {} shards in directory {}'.format(len(tasks), shards, save_path))
+    if len(tasks) > 0:
+        with multiprocessing.Pool(min(len(tasks), shards)) as pool:
+            for shard, fc, elapsed in pool.imap_unordered(_build_shard, tasks):
+                with open(done_path, 'a') as fw:
+                    fw.write('{}\n'.format(shard))
+                LOGGER.info('Shard {}: {} files in {:.1f}s [{:.1f} d/s]'.format(shard, fc, elapsed, fc / elapsed))
+                print('Shard {}: {} files [{:.1f} d/s]'.format(shard, fc, fc / elapsed))
+
+    st = time.time()
+    # merged aside and moved into save_path once committed, so that a crash in the merge leaves no index there
+    # and the next run resumes from the finished shards
+    merge_path = os.path.join(shards_path, '_merge')
+    if os.path.exists(merge_path):
+        shutil.rmtree(merge_path)
+    os.makedirs(merge_path)
+    writer = create_in(merge_path, schema).writer(limitmb=config.BUILD_limitmb)
+    for shard_path in shard_paths:
+        with open_dir(shard_path, readonly=True).reader() as shard_reader:
+            writer.add_reader(shard_reader)
+    writer.commit()
+    # the table of contents goes last, as it is what makes save_path an index
+    for name in sorted(os.listdir(merge_path), key=lambda n: n.endswith('.toc')):
+        os.replace(os.path.join(merge_path, name), os.path.join(save_path, name))
+    LOGGER.info('Shards merged into {} [{:.1f}s]'.format(save_path, time.time() - st))
+    shutil.rmtree(shards_path)
+    forward.export(open_dir(save_path))
+    return
+
+
+class _PartitionReader(object):
+    """A reader of an index showing only the documents of a partition, the others read as deleted, so that
+    writer.add_reader copies their stored fields, lengths, vectors, columns and postings as they are"""
+
+    def __init__(self, ix_reader, docnums: DocnumBitmap):
+        self._reader = ix_reader
+        self._docnums = docnums
+
+    def __getattr__(self, name):
+        return getattr(self._reader, name)
+
+    def has_deletions(self):
+        return True
+
+    def is_deleted(self, docnum):
+        return docnum not in self._docnums
+
+    def doc_count(self):
+        return len(self._docnums)
+
+    def iter_docs(self):
+        stored_fields = self._reader.stored_fields
+        for docnum in self._docnums:
+            yield docnum, stored_fields(docnum)
+
+    def iter_postings(self):
+        docnums = self._docnums
+        for item in self._reader.iter_postings():
+            if item[2] in docnums:
+                yield item
+
+
+def build_partition_index(partition: IndexVirtualPartition, save_path: str):
+    """Materializes a partition (e.g. a cache) as an optimized index of its own in save_path, with the schema of
+    the index. Its documents are copied from the index rather than analyzed again; their order is kept."""
+    st = time.time()
+    if not os.path.exists(save_path):
+        os.mkdir(save_path)
+    if exists_in(save_path):
+        save_path = save_path + '_{}'.format(time.strftime('%m%d_%H%M'))
+        if not os.path.exists(save_path):
+            os.mkdir(save_path)
+    ix = create_in(save_path, schema)
+    writer = ix.writer(limitmb=config.BUILD_limitmb)
+    writer.add_reader(_PartitionReader(partition._reader, partition.get_docnum_set()))
+    writer.commit(optimize=True)
+    LOGGER.info('Partition {} ({} documents) materialized in {} [{:.1f}s]'
+                .format(partition.name, partition.doc_count(), save_path, time.time() - st))
+    forward.export(ix)
+    return ix
+
+
 if __name__ == '__main__':
     c = config.get_paths()
-    if len(sys.argv) >= 4:
+    if len(sys.argv) >= 5:
+        config.setup_logger('{}-{}-{}_build'.format(sys.argv[1], sys.argv[2], sys.argv[3]))
+        build_index_wiki13_sharded(c[sys.argv[1]], c[sys.argv[2]], c[sys.argv[3]], int(sys.argv[4]))
+    elif len(sys.argv) >= 4:
         config.setup_logger('{}-{}-{}_build'.format(sys.argv[1], sys.argv[2], sys.argv[3]))
         build_index_wiki13(c[sys.argv[1]], c[sys.argv[2]], c[sys.argv[3]])
     else:
-        print('dir_alias, index_alias, count_alias is required!')
+        print('dir_alias, index_alias, count_alias is required! (add a number of shards for a parallel build)')
 
@@ -5,6 +5,9 @@ BUILD_limitmb = 1024
 BUILD_procs = 4
 BUILD_multisegment = True
 
+# Number of documents scored together as one sparse matrix in divergence calculations
+DIVERGENCE_batch_size = 20000
+
 
 def setup_logger(file_name=None):
     if not os.path.exists('log'):
@@ -44,11 +47,20 @@ def build_wiki13_title_count(file_path):
     wiki13_title_count = {}
     with codecs.open(file_path, 'r', encoding='utf-8') as fo:
         for l in fo:
-            lparts = l.split(',')
-            artic_id = get_article_id_from_file_name(lparts[0].rsplit('/', 1)[1].strip())
-            artic_count = int(lparts[1].strip())
-            artic_title = lparts[2].strip()
+            artic_id, artic_count, artic_title = parse_wiki13_title_count_line(l)
             wiki13_title_count[artic_id] = {'title': artic_title, 'count': artic_count}
     return wiki13_title_count
 
 
+# A line of the page-count file: path/to/<articleID>.txt,count,title
+def parse_wiki13_title_count_line(line):
+    lparts = line.split(',')
+    artic_id = get_article_id_from_file_name(lparts[0].rsplit('/', 1)[1].strip())
+    artic_count = int(lparts[1].strip())
+    artic_title = lparts[2].strip()
+    return artic_id, artic_count, artic_title
+
+
+# Derived data (snapshots, lookup tables, ...) is kept in a sub-directory of the index directory
+def index_sidecar_path(file_index, name):
+    return os.path.join(file_index.storage.folder, '_sidecar', name)
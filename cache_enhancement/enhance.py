@@ -15,7 +15,7 @@ def partition_and_generate_distributions(index_name: str):
     with ix.reader() as ix_reader:
         pa = pt.Partitioner(ix, ix_reader)
         print('Partitioner initiated!')
-        parts = pa.generate([0.98, 0.1])
+        parts = pa.generate([0.98, 0.1], shared_scan=True)
         parts = [p for p in parts]
         print('Parts created!')
         print('naive1 ({}, {})'.format(parts[0].name, parts[1].name))
@@ -33,14 +33,14 @@ if __name__ == '__main__':
     # cache_ranges = [(0.0, 1.0)]
     # disk_ranges = [(0.0, 0.2), (0.0, 1.0)]
     #
-    # for c in cache_ranges:
-    #     for d in disk_ranges:
-    #         sol.naive1(cache_distribution_path=cache_distribution_path, disk_distribution_path=disk_distribution_path,
-    #                    save_log_path=save_dir, use_column_with_index=2, cache_start_range=c[0], cache_end_range=c[1],
-    #                    disk_start_range=d[0], disk_end_range=d[1], equal_add_delete=True)
-    #         # sol.naive2(cache_distribution_path=cache_distribution_path, disk_distribution_path=disk_distribution_path,
-    #         #            save_log_path=save_dir, change_fraction=0.17, cache_start_range=c[0], cache_end_range=c[1],
-    #         #            disk_start_range=d[0], disk_end_range=d[1], equal_add_delete=True)
+    # sol.naive_sweep('naive1', cache_distribution_path=cache_distribution_path,
+    #                 disk_distribution_path=disk_distribution_path, save_log_path=save_dir,
+    #                 cache_ranges=cache_ranges, disk_ranges=disk_ranges, use_column_with_index=2,
+    #                 equal_add_delete=True)
+    # # sol.naive_sweep('naive2', cache_distribution_path=cache_distribution_path,
+    # #                 disk_distribution_path=disk_distribution_path, save_log_path=save_dir,
+    # #                 cache_ranges=cache_ranges, disk_ranges=disk_ranges, change_fractions=[0.17],
+    # #                 equal_add_delete=True)
     index_name = "wiki13_index"
     configuration = config.get_paths()
     ix = index.open_dir(configuration[index_name], readonly=True)
@@ -48,7 +48,7 @@ if __name__ == '__main__':
     with ix.reader() as ix_reader:
         pa = pt.Partitioner(ix, ix_reader)
         LOGGER.info('Partitioner initiated!')
-        parts = pa.generate([0.98, 0.0])
+        parts = pa.generate([0.98, 0.0], shared_scan=True)
         parts = [p for p in parts]
         LOGGER.info('recursive ({}, {})'.format(parts[0].name, parts[1].name))
         sol.recursive_refine(cache=parts[0], disk=parts[1], save_log_path="/data/khodadaa/lucene-index/recursive")
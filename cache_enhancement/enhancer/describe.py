@@ -1,17 +1,58 @@
 from partition import IndexVirtualPartition
-from collections import defaultdict
-import operator
+from fieldcache import StoredFieldColumns, pack_strings
+import numpy as np
 from time import time, strftime
 import logging
 import config
+import os
 
 LOGGER = logging.getLogger()
 
 
+class _DocnumValues(object):
+    """Values of documents aligned by docnum over the docnum space of the index, with a mask of the documents
+    that have one. Divergences assigned by hand are ints; they are flagged so, as they are written differently."""
+
+    def __init__(self, size: int, dtype=np.float64):
+        self.values = np.zeros(size, dtype=dtype)
+        self.known = np.zeros(size, dtype=bool)
+        self.ints = np.zeros(size, dtype=bool)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.known))
+
+    def set(self, docnums, values, ints=False):
+        docnums = np.asarray(docnums, dtype=np.int64)
+        self.values[docnums] = values
+        self.known[docnums] = True
+        self.ints[docnums] = ints
+
+    def update(self, distribution: dict):
+        """sets the values of a {docnum: value} dict, e.g. of docs_divergence"""
+        self.set(np.fromiter(distribution.keys(), dtype=np.int64, count=len(distribution)),
+                 np.fromiter(distribution.values(), dtype=self.values.dtype, count=len(distribution)),
+                 np.fromiter((type(v) is int for v in distribution.values()), dtype=bool, count=len(distribution)))
+
+    def docnums(self) -> np.ndarray:
+        return np.flatnonzero(self.known)
+
+    def get(self, docnums: np.ndarray) -> np.ndarray:
+        """float values of the docnums; nan where a document has no value"""
+        return np.where(self.known[docnums], self.values[docnums], np.nan)
+
+    def items(self, docnums: np.ndarray) -> list:
+        """values of the docnums as python numbers, the ones assigned by hand as ints"""
+        values = self.values[docnums].tolist()
+        ints = self.ints[docnums]
+        if ints.any():
+            values = [int(v) if i else v for v, i in zip(values, ints.tolist())]
+        return values
+
+
 class PartitionDescriptor(object):
 
     def __init__(self, this_partition: IndexVirtualPartition, cross_partition: IndexVirtualPartition,
-                 scoring_type='tf', similarity_measure_type='avg-kld', update_modes=['pop']):
+                 scoring_type='tf', similarity_measure_type='avg-kld', update_modes=['pop'], procs=1):
         self._partition = this_partition
         self._cross_partition = cross_partition
         self.scoring_type = scoring_type
@@ -19,30 +60,40 @@ class PartitionDescriptor(object):
         self._ixreader = this_partition._reader
         self._ixsearcher = this_partition._searcher
         self.name = this_partition.name + '_vs_' + cross_partition.name
+        self._stored_columns = None
         self.pop_distribution = None
         self.divergence_distribution = None
         self.cross_divergence_distribution = None
-        self.update(distributions=update_modes)
+        # term probabilities of the compared partitions the divergences were calculated with; keyed by cross
+        self._reference_probabilities = {}
+        self.update(distributions=update_modes, procs=procs)
 
-    def update(self, distributions: list):
+    def update(self, distributions: list, procs=1):
+        # procs: number of worker processes for the divergence distributions
         for mode in distributions:
             if mode == 'pop':
                 self._update_popularity_distribution()
             if mode == 'div':
-                self._update_divergence_distribution(cross=False)
+                self._update_divergence_distribution(cross=False, procs=procs)
             if mode == 'cross-div':
-                self._update_divergence_distribution(cross=True)
+                self._update_divergence_distribution(cross=True, procs=procs)
 
     def _update_popularity_distribution(self):
         LOGGER.info('{}\'s popularity distribution is being updated...'.format(self.name))
         st = time()
-        pop_dist = defaultdict(int)
-        for dn in self._partition.get_docnums():
-            pop_dist[dn] = self._ixreader.stored_fields(dn)['count']
+        docnums = self._partition.get_docnum_set().to_array()
+        pop_dist = _DocnumValues(self._partition.get_docnum_set().size, np.int64)
+        pop_dist.set(docnums, self._get_stored_columns().column('count')[docnums])
         self.pop_distribution = pop_dist
 
         LOGGER.info('{}\'s popularity distribution is updated. [{:.4f}s]'.format(self.name, time()-st))
 
+    def _get_stored_columns(self) -> StoredFieldColumns:
+        if self._stored_columns is None or \
+                self._stored_columns.generation != self._partition.ix.latest_generation():
+            self._stored_columns = StoredFieldColumns.open(self._partition.ix, ix_reader=self._ixreader)
+        return self._stored_columns
+
     def get_sorted(self, mode='div', reverse=True):
         if mode == 'pop':
             d = self.pop_distribution
@@ -50,46 +101,170 @@ class PartitionDescriptor(object):
             d = self.divergence_distribution
         if mode == 'cross-div':
             d = self.cross_divergence_distribution
-        return sorted(d.items(), key=operator.itemgetter(1), reverse=reverse)
+        # stable, like sorting the (docnum, value) items
+        docnums = d.docnums()
+        order = np.argsort(-d.values[docnums] if reverse else d.values[docnums], kind='mergesort')
+        return list(zip(docnums[order].tolist(), d.items(docnums[order])))
 
-    def _update_divergence_distribution(self, cross=False):
+    def _update_divergence_distribution(self, cross=False, procs=1):
         LOGGER.info('{}\'s {} {} distribution is being updated...'
                     .format(self.name, self.scoring_type, self.similarity_measure))
         st = time()
+        partition = self._cross_partition if cross else self._partition
+        self._reference_probabilities[cross] = partition.term_probabilities()
+        dist = _DocnumValues(self._partition.get_docnum_set().size)
+        dist.update(partition.docs_divergence(self._partition.get_docnums(), self.similarity_measure,
+                                              self.scoring_type, 'body', batch_size=config.DIVERGENCE_batch_size,
+                                              procs=procs))
         if not cross:
-            self.divergence_distribution = \
-                self._partition.docs_divergence(self._partition.get_docnums(),
-                                                self.similarity_measure,
-                                                self.scoring_type,
-                                                'body')
+            self.divergence_distribution = dist
         else:
-            self.cross_divergence_distribution = \
-                self._cross_partition.docs_divergence(self._partition.get_docnums(),
-                self.similarity_measure, self.scoring_type, 'body')
+            self.cross_divergence_distribution = dist
 
         LOGGER.info('{}\'s {} {} distribution is updated. [{:.4f}s]'
                      .format(self.name, self.scoring_type, self.similarity_measure, time()-st))
 
-    def save(self, file_path="data"):
+    def refresh(self, tolerance: float=1e-3, procs=1):
+        """Brings the distributions up to date after documents were added to or removed from the partitions.
+        Documents that left this partition are masked out and new ones are added. A remaining document is
+        re-scored only if it has a term whose probability in the compared partition changed by more than tolerance
+        (relative) since the divergences were calculated."""
+        st = time()
+        members = self._partition.get_docnum_set().mask()
+        docnums = np.flatnonzero(members)
+        distributions = [(self.pop_distribution, None),
+                         (self.divergence_distribution, False),
+                         (self.cross_divergence_distribution, True)]
+        for dist, cross in distributions:
+            if dist is None:
+                continue
+            dist.known &= members
+            kept = dist.known[docnums]
+            missing = docnums[~kept]
+            if cross is None:
+                dist.set(missing, self._get_stored_columns().column('count')[missing])
+                continue
+            if cross not in self._reference_probabilities:
+                # restored by load_state; there is nothing to compare the partition with
+                self._update_divergence_distribution(cross=cross, procs=procs)
+                continue
+            partition = self._cross_partition if cross else self._partition
+            reference = self._reference_probabilities[cross]
+            probabilities = partition.term_probabilities()
+            changed = np.abs(probabilities - reference) > tolerance * reference
+            stale = partition.docs_with_terms(docnums[kept].tolist(), changed)
+            LOGGER.info('{}: {} terms changed in {}; re-scoring {} documents and {} new ones'
+                        .format(self.name, int(changed.sum()), partition.name, len(stale), len(missing)))
+            dist.update(partition.docs_divergence(stale + missing.tolist(), self.similarity_measure,
+                                                  self.scoring_type, 'body', batch_size=config.DIVERGENCE_batch_size,
+                                                  procs=procs))
+            reference[changed] = probabilities[changed]
+        LOGGER.info('{}\'s distributions are refreshed. [{:.4f}s]'.format(self.name, time()-st))
+
+    def aligned(self, modes: list=['pop', 'div', 'cross-div']):
+        """(docnums, [values of every mode]) as arrays aligned by the (sorted) docnums of this partition;
+        nan where a distribution has no value for a document"""
+        docnums = self._partition.get_docnum_set().to_array()
+        distributions = self._distributions()
+        return docnums, [distributions[mode].get(docnums) for mode in modes]
+
+    def _distributions(self) -> dict:
+        return {'pop': self.pop_distribution, 'div': self.divergence_distribution,
+                'cross-div': self.cross_divergence_distribution}
+
+    def has_distribution(self, mode: str) -> bool:
+        return self._distributions()[mode] is not None
+
+    def save_state(self, file_path: str):
+        """Saves the distributions computed so far to an .npz file (written to a temporary file first)"""
+        arrays = {}
+        for mode, dist in self._distributions().items():
+            if dist is not None:
+                docnums = dist.docnums()
+                arrays[mode + '_docnums'] = docnums
+                arrays[mode + '_values'] = dist.values[docnums]
+                arrays[mode + '_ints'] = dist.ints[docnums]
+        tmp_path = file_path + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, file_path)
+
+    def load_state(self, file_path: str):
+        """Restores the distributions saved by save_state"""
+        with np.load(file_path) as state:
+            for mode in self._distributions():
+                if mode + '_docnums' not in state.files:
+                    continue
+                dist = _DocnumValues(self._partition.get_docnum_set().size, np.int64 if mode == 'pop' else np.float64)
+                dist.set(state[mode + '_docnums'], state[mode + '_values'], state[mode + '_ints'])
+                if mode == 'pop':
+                    self.pop_distribution = dist
+                elif mode == 'div':
+                    self.divergence_distribution = dist
+                else:
+                    self.cross_divergence_distribution = dist
+
+    def save(self, file_path="data", file_format='csv', block_size: int=100000):
+        """Writes the distributions, the most popular documents first, to <file_path>/<time>_<name>.csv,
+        or to a columnar .npz with file_format='npz' (both read by solutions.load_distribution_csv).
+        Rows are made and written block_size documents at a time."""
         if file_path[-1] == '/':
             file_path = file_path[:-1]
-        file_path += '/{}_{}.csv'.format(strftime('%m%d_%H%M%S'), self.name)
-        pop_distrib = self.get_sorted('pop')
-        with open(file_path, 'w') as w:
-            w.write('articleId::{0}, popularity, cross-this_{1}, cross_{1}, {1}, docnum, count, xpath\n'.
-                    format(self.name, self.scoring_type+self.similarity_measure))
-            for docnum, pop in pop_distrib:
-                sf = self._ixreader.stored_fields(docnum)
-                cross_div = self.cross_divergence_distribution[docnum] if \
-                            self.cross_divergence_distribution is not None else 0.0
-                div = self.divergence_distribution[docnum] if \
-                    self.divergence_distribution is not None else 0.0
-                w.write('{},{},{},{},{},{},{},{}\n'
-                        .format(sf['articleID'],
-                                pop,
-                                cross_div - div,
-                                cross_div,
-                                div,
-                                docnum,
-                                sf['count'],
-                                sf['xpath']))
+        file_path += '/{}_{}.{}'.format(strftime('%m%d_%H%M%S'), self.name, file_format)
+        measure = self.scoring_type + self.similarity_measure
+        header = ['articleId::' + self.name, 'popularity', 'cross-this_' + measure, 'cross_' + measure, measure,
+                  'docnum', 'count', 'xpath']
+        # stable, like sorting the items by popularity in reverse
+        docnums = self.pop_distribution.docnums()
+        pops = self.pop_distribution.values[docnums]
+        order = np.argsort(-pops, kind='mergesort')
+        docnums, pops = docnums[order], pops[order]
+        blocks = (self._save_block(docnums[bst:bst + block_size], pops[bst:bst + block_size])
+                  for bst in range(0, len(docnums), block_size))
+        if file_format == 'npz':
+            self._save_npz(file_path, header, blocks, len(docnums))
+            return
+        with open(file_path, 'w', buffering=1 << 20) as w:
+            w.write(', '.join(header) + '\n')
+            for block in blocks:
+                w.write(''.join('{},{},{},{},{},{},{},{}\n'.format(*row) for row in zip(*block)))
+
+    def _save_block(self, docnums: np.ndarray, pops: np.ndarray) -> list:
+        """the columns of a block of rows of save"""
+        dns = docnums.tolist()
+        cross_div = self.cross_divergence_distribution.items(docnums) \
+            if self.cross_divergence_distribution is not None else [0.0] * len(dns)
+        div = self.divergence_distribution.items(docnums) \
+            if self.divergence_distribution is not None else [0.0] * len(dns)
+        columns = self._get_stored_columns()
+        return [columns.values('articleID', dns), pops.tolist(), [c - d for c, d in zip(cross_div, div)],
+                cross_div, div, dns, columns.values('count', dns), columns.values('xpath', dns)]
+
+    @staticmethod
+    def _save_npz(file_path: str, header: list, blocks, rows: int):
+        """numeric columns as arrays and string columns as pack_strings buffers, under the header names.
+        Numeric columns are allocated for all the rows and filled a block at a time; string columns are packed
+        a block at a time and joined at the end."""
+        keys = [name.split('::')[0] for name in header]
+        arrays = {'__columns__': np.array(header)}
+        offsets, data, sizes = {}, {}, {}
+        for key in keys:
+            if key in ('articleId', 'xpath'):
+                offsets[key], data[key], sizes[key] = [np.zeros(1, dtype=np.int64)], [np.zeros(0, dtype=np.uint8)], 0
+            else:
+                arrays[key] = np.empty(rows, dtype=np.int64 if key in ('popularity', 'docnum', 'count')
+                                       else np.float64)
+        start = 0
+        for block in blocks:
+            end = start + len(block[0])
+            for key, column in zip(keys, block):
+                if key in offsets:
+                    block_offsets, block_data = pack_strings(str(v) for v in column)
+                    offsets[key].append(block_offsets[1:] + sizes[key])
+                    data[key].append(block_data)
+                    sizes[key] += len(block_data)
+                else:
+                    arrays[key][start:end] = column
+            start = end
+        for key in offsets:
+            arrays[key + '.offsets'], arrays[key + '.data'] = np.concatenate(offsets[key]), np.concatenate(data[key])
+        np.savez(file_path, **arrays)
@@ -1,24 +1,45 @@
 import partition as pt
 from enhancer.describe import PartitionDescriptor
+from forward import ForwardIndex
+from fieldcache import StoredFieldColumns, unpack_strings
+from whoosh import index
+from whoosh.reading import IndexReader
+import numpy as np
 import logging
 import pandas as pd
+import json
 import sys
+import io
+import os
 
 LOGGER = logging.getLogger()
 
+_LINE_OFFSETS = {}
 
-def load_distribution_csv(file_path: str, start_range: float=0.0, end_range: float=1.0) -> pd.DataFrame:
-    lines = 0
-    with open(file_path, 'r') as fo:
-        for l in fo:
-            lines += 1
 
-    skip_range = range(1, int(start_range * lines))  # keeps first row for column names
-    nbr_rows_to_read = int((end_range-start_range) * lines)
-    distribution_df = pd.read_csv(file_path, sep=',', nrows=nbr_rows_to_read, skiprows=skip_range,
-                                  skipinitialspace=True)
+def load_distribution_csv(file_path: str, start_range: float=0.0, end_range: float=1.0,
+                          columns: list=None, chunk_size: int=1000000) -> pd.DataFrame:
+    """Rows in [start_range, end_range) (fractions of the file) of a distribution saved by
+    PartitionDescriptor.save, as .csv or .npz; columns limits the columns that are read.
+    Only the requested rows of a .csv are read, found with its line_offsets, chunk_size rows at a time."""
+    if file_path.endswith('.npz'):
+        return _load_distribution_npz(file_path, start_range, end_range, columns)
+    offsets = line_offsets(file_path)
+    first, last = _row_range(len(offsets) - 1, start_range, end_range)
+    usecols = (lambda c: c.split('::')[0] in columns) if columns is not None else None
+    with open(file_path, 'rb') as fo:
+        header = fo.read(int(offsets[1]))
+        chunks = []
+        for cst in range(first, last, chunk_size):
+            cen = min(cst + chunk_size, last)
+            fo.seek(int(offsets[cst + 1]))
+            chunks.append(pd.read_csv(io.BytesIO(header + fo.read(int(offsets[cen + 1] - offsets[cst + 1]))),
+                                      sep=',', skipinitialspace=True, usecols=usecols))
+    if len(chunks) == 0:
+        chunks.append(pd.read_csv(io.BytesIO(header), sep=',', skipinitialspace=True, usecols=usecols))
+    distribution_df = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
 
-    first_column_name = distribution_df.columns[0]
+    first_column_name = header.decode('utf-8').split(',')[0].strip()
     parts = first_column_name.split('::')
     distribution_df = distribution_df.rename(columns={first_column_name: parts[0]})
     distribution_df.columns.name = parts[1]
@@ -26,59 +47,311 @@ def load_distribution_csv(file_path: str, start_range: float=0.0, end_range: flo
     return distribution_df
 
 
+def _row_range(lines: int, start_range: float, end_range: float) -> tuple:
+    """Data rows [first, last) in [start_range, end_range) of a distribution file of lines lines: lines
+    [1, start * lines) are skipped (line 0 has the column names) and (end - start) * lines of them are read"""
+    first = max(int(start_range * lines) - 1, 0)
+    return first, min(first + max(int((end_range - start_range) * lines), 0), lines - 1)
+
+
+def line_offsets(file_path: str) -> np.ndarray:
+    """Byte offsets of the starts of the lines of a file, and its size at the end. They are kept in
+    <file_path>.lines.npz and found again when the file has not changed since."""
+    stat = os.stat(file_path)
+    signature = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if key in _LINE_OFFSETS:
+        return _LINE_OFFSETS[key]
+    index_path = file_path + '.lines.npz'
+    offsets = None
+    if os.path.exists(index_path):
+        with np.load(index_path) as saved:
+            if np.array_equal(saved['signature'], signature):
+                offsets = saved['offsets']
+    if offsets is None:
+        starts = [np.zeros(1, dtype=np.int64)]
+        position = 0
+        with open(file_path, 'rb') as fo:
+            while True:
+                block = fo.read(1 << 26)
+                if len(block) == 0:
+                    break
+                starts.append(np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n')) + position + 1)
+                position += len(block)
+        offsets = np.concatenate(starts)
+        if offsets[-1] != stat.st_size:
+            # the last line has no line break
+            offsets = np.append(offsets, stat.st_size)
+        if stat.st_size == 0:
+            offsets = offsets[:1]
+        try:
+            np.savez(file_path + '.lines.tmp.npz', offsets=offsets, signature=signature)
+            os.replace(file_path + '.lines.tmp.npz', index_path)
+        except OSError as e:
+            LOGGER.warning('Line offsets of {} could not be saved: {}'.format(file_path, e))
+    _LINE_OFFSETS[key] = offsets
+    return offsets
+
+
+def _load_distribution_npz(file_path: str, start_range: float, end_range: float, columns: list=None):
+    """load_distribution_csv of a .npz; the rows are those the .csv of the same data would give"""
+    with np.load(file_path) as distribution:
+        header = distribution['__columns__'].tolist()
+        names = [h.split('::')[0] for h in header]
+        # the same rows as from the .csv
+        first, last = _row_range(len(distribution['docnum']) + 1, start_range, end_range)
+        data = {}
+        for name in names:
+            if columns is not None and name not in columns:
+                continue
+            if name + '.offsets' in distribution.files:
+                values = unpack_strings(distribution[name + '.offsets'], distribution[name + '.data'],
+                                        np.arange(first, last))
+                if name == 'articleId':
+                    # read as numbers, as from the .csv, when they all are
+                    values = pd.Series(values)
+                    if values.str.match(r'-?\d+$').all():
+                        values = values.astype(np.int64)
+                data[name] = values
+            else:
+                data[name] = distribution[name][first:last]
+    distribution_df = pd.DataFrame(data, columns=[n for n in names if n in data])
+    distribution_df.columns.name = header[0].split('::')[1]
+    return distribution_df
+
+
 def generate_distance_distributions(cache: pt.IndexVirtualPartition, disk: pt.IndexVirtualPartition,
-                                    save_path: str, distance_type: list=['avg-kld']):
+                                    save_path: str, distance_type: list=['avg-kld'], procs: int=1,
+                                    checkpoint_dir: str=None):
+    """Saves the distributions of cache vs disk for every distance type.
+    With a checkpoint_dir, the partitions and every computed distribution are saved there as they are done,
+    and resume_distance_distributions carries on from what is already computed."""
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        for file_name in os.listdir(checkpoint_dir):
+            if file_name.endswith('_distributions.npz'):
+                os.remove(os.path.join(checkpoint_dir, file_name))
+        cache.save_state(os.path.join(checkpoint_dir, 'cache.npz'))
+        disk.save_state(os.path.join(checkpoint_dir, 'disk.npz'))
+        _write_json(os.path.join(checkpoint_dir, 'params.json'),
+                    {'save_path': save_path, 'distance_type': list(distance_type)})
+        _write_json(os.path.join(checkpoint_dir, 'progress.json'), {'done': []})
+    _distance_distributions(cache, disk, save_path, distance_type, procs, checkpoint_dir)
+
+
+def resume_distance_distributions(checkpoint_dir: str, file_index: index.FileIndex, ix_reader: IndexReader=None,
+                                  procs: int=1):
+    """Carries on generate_distance_distributions from its checkpoint_dir, with the partitions saved there"""
+    params = _read_json(os.path.join(checkpoint_dir, 'params.json'))
+    cache, disk = _load_partitions(checkpoint_dir, 'cache.npz', file_index, ix_reader)
+    _distance_distributions(cache, disk, params['save_path'], params['distance_type'], procs, checkpoint_dir)
+
+
+def _distance_distributions(cache: pt.IndexVirtualPartition, disk: pt.IndexVirtualPartition,
+                            save_path: str, distance_type: list, procs: int, checkpoint_dir: str=None):
+    done = _read_json(os.path.join(checkpoint_dir, 'progress.json'))['done'] if checkpoint_dir is not None else []
+
     def repeat(sm, sc):
         div_val = pt.divergence(cache, disk, similarity_measure_type=sm, score_type=sc)
         LOGGER.info('{} {} ivergence({}, {}) = {}'.format(sc, sm, cache.name, disk.name, div_val))
-        des = PartitionDescriptor(cache, disk, similarity_measure_type=sm, update_modes=['pop', 'div', 'cross-div'])
+        des = PartitionDescriptor(cache, disk, similarity_measure_type=sm, update_modes=[], procs=procs)
+        stage_path = os.path.join(checkpoint_dir, '{}_{}_distributions.npz'.format(sc, sm)) \
+            if checkpoint_dir is not None else None
+        if stage_path is not None and os.path.exists(stage_path):
+            des.load_state(stage_path)
+        for mode in ['pop', 'div', 'cross-div']:
+            if not des.has_distribution(mode):
+                des.update(distributions=[mode], procs=procs)
+                if stage_path is not None:
+                    des.save_state(stage_path)
         print('saving in {} ...'.format(save_path))
         des.save(save_path)
 
     for d in distance_type:
+        if d in done:
+            LOGGER.info('{} distributions of {} are already saved; skipped'.format(d, cache.name))
+            continue
         repeat(sm=d, sc='tf')
+        if checkpoint_dir is not None:
+            done.append(d)
+            _write_json(os.path.join(checkpoint_dir, 'progress.json'), {'done': done})
 
 
-def recursive_refine(cache: pt.IndexVirtualPartition, disk: pt.IndexVirtualPartition,
-                     save_log_path: str, distance_type: str='kld', score_type: str='tf'):
-    removed_docs_cache = []
-    prev_div_val = 0.0
-    step = 0
-    while step < 25:
-        step += 1
-        LOGGER.info("round: {}, cache size: {}".format(step, cache.doc_count()))
-        print("round: {}, cache size: {}".format(step, cache.doc_count()))
-        div_val = pt.divergence(cache, disk, similarity_measure_type=distance_type, score_type=score_type)
-        LOGGER.info('{} {} ivergence({}, {}) = {}'.format(distance_type, score_type, cache.name, disk.name, div_val))
-        if div_val <= prev_div_val:
-            break
-        prev_div_val = div_val
-        descriptor_cache_vs_disk = PartitionDescriptor(cache, disk, similarity_measure_type=distance_type,
-                                                       update_modes=['pop', 'div', 'cross-div'])
-        pop_distrib = descriptor_cache_vs_disk.pop_distribution
-        div_distrib = descriptor_cache_vs_disk.divergence_distribution
-        cross_div_distrib = descriptor_cache_vs_disk.cross_divergence_distribution
-
-        cname = score_type+distance_type
-        cache_df = pd.DataFrame({'popularity': pop_distrib, cname : div_distrib, 'cross_'+cname: cross_div_distrib})
-        remove_candidates = list(cache_df[cache_df['cross_'+cname]-cache_df[cname] < 0].index)
-        for dn in remove_candidates:
-            articleId = cache._reader.stored_fields(dn)['articleID']
-            removed_docs_cache.append(articleId)
-            cache.remove_doc(dn)
+def select_candidates(docnums: np.ndarray, margins: np.ndarray, threshold: float=0.0, top_k: int=None) -> np.ndarray:
+    """docnums whose margin is below threshold, in docnum order; with top_k, only the (at most) top_k of them with
+    the lowest margins, from the lowest. nan margins are never selected."""
+    selected = np.flatnonzero(margins < threshold)
+    if top_k is not None and len(selected) > top_k:
+        selected = selected[np.argpartition(margins[selected], top_k - 1)[:top_k]]
+    if top_k is not None:
+        selected = selected[np.argsort(margins[selected], kind='mergesort')]
+    return docnums[selected]
+
 
+def recursive_refine(cache: pt.IndexVirtualPartition, disk: pt.IndexVirtualPartition,
+                     save_log_path: str, distance_type: str='kld', score_type: str='tf',
+                     max_rounds: int=25, tolerance: float=1e-3, procs: int=1, checkpoint: bool=True,
+                     threshold: float=0.0, top_k: int=None):
+    """Removes the cache documents that are closer to disk than to cache, round by round, while the divergence of
+    cache from disk grows. The divergence is maintained incrementally and only the documents affected by the
+    removals are re-scored in each round (see PartitionDescriptor.refresh for tolerance).
+    A document is removed when (cross divergence - divergence) < threshold; with top_k, at most top_k documents
+    of the lowest margins are removed per round (see select_candidates).
+    With checkpoint, the cache partition, the removed documents and the divergences are saved after every round
+    in save_log_path/recur_<cache>_<disk>_checkpoint, from where resume_recursive_refine carries on."""
     save_log_path = save_log_path[:-1] if save_log_path[-1] == '/' else save_log_path
+    checkpoint_dir = None
+    if checkpoint:
+        checkpoint_dir = '{}/recur_{}_{}_checkpoint'.format(save_log_path, cache.name, disk.name)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+    state = {'save_log_path': save_log_path, 'distance_type': distance_type, 'score_type': score_type,
+             'max_rounds': max_rounds, 'tolerance': tolerance, 'threshold': threshold, 'top_k': top_k,
+             'round': 0, 'divergences': [], 'finished': False}
+    if checkpoint_dir is not None:
+        disk.save_state(os.path.join(checkpoint_dir, 'disk.npz'))
+        _save_round(checkpoint_dir, cache, state, [])
+    _refine_rounds(cache, disk, state, [], procs, checkpoint_dir)
+
+
+def resume_recursive_refine(checkpoint_dir: str, file_index: index.FileIndex, ix_reader: IndexReader=None,
+                            procs: int=1):
+    """Carries on recursive_refine from the last round saved in checkpoint_dir, without rebuilding the
+    partitions from the index"""
+    state = _read_json(os.path.join(checkpoint_dir, 'state.json'))
+    cache, disk = _load_partitions(checkpoint_dir, 'cache_r{}.npz'.format(state['round']), file_index, ix_reader)
+    removed_docs_cache = np.load(os.path.join(checkpoint_dir, 'removed_r{}.npy'.format(state['round']))).tolist()
+    LOGGER.info('Resuming recursive refine of {} after round {}'.format(cache.name, state['round']))
+    _refine_rounds(cache, disk, state, removed_docs_cache, procs, checkpoint_dir)
+
+
+def _refine_rounds(cache: pt.IndexVirtualPartition, disk: pt.IndexVirtualPartition, state: dict,
+                   removed_docs_cache: list, procs: int, checkpoint_dir: str=None):
+    distance_type, score_type, tolerance = state['distance_type'], state['score_type'], state['tolerance']
+    prev_div_val = state['divergences'][-1] if len(state['divergences']) > 0 else 0.0
+    step = state['round']
+    tracker = cache.track_divergence(disk, distance_type, tolerance) if score_type == 'tf' else None
+    descriptor_cache_vs_disk = None
+    try:
+        while not state['finished'] and step < state['max_rounds']:
+            step += 1
+            LOGGER.info("round: {}, cache size: {}".format(step, cache.doc_count()))
+            print("round: {}, cache size: {}".format(step, cache.doc_count()))
+            if tracker is not None:
+                div_val = tracker.value()
+            else:
+                div_val = pt.divergence(cache, disk, similarity_measure_type=distance_type, score_type=score_type)
+            LOGGER.info('{} {} ivergence({}, {}) = {}'
+                        .format(distance_type, score_type, cache.name, disk.name, div_val))
+            if div_val <= prev_div_val:
+                break
+            prev_div_val = div_val
+            if descriptor_cache_vs_disk is None:
+                descriptor_cache_vs_disk = PartitionDescriptor(cache, disk, similarity_measure_type=distance_type,
+                                                               update_modes=['pop', 'div', 'cross-div'], procs=procs)
+            else:
+                descriptor_cache_vs_disk.refresh(tolerance, procs=procs)
+            docnums, (div_distrib, cross_div_distrib) = descriptor_cache_vs_disk.aligned(['div', 'cross-div'])
+            remove_candidates = select_candidates(docnums, cross_div_distrib - div_distrib,
+                                                  state.get('threshold', 0.0), state.get('top_k'))
+            LOGGER.info('{} documents selected for removal'.format(len(remove_candidates)))
+            removed_docs_cache += remove_candidates.tolist()
+            cache.remove_docs(remove_candidates)
+            state['round'] = step
+            state['divergences'].append(div_val)
+            if checkpoint_dir is not None:
+                _save_round(checkpoint_dir, cache, state, removed_docs_cache)
+    finally:
+        if tracker is not None:
+            cache.untrack(tracker)
+    state['finished'] = True
+    if checkpoint_dir is not None:
+        _write_json(os.path.join(checkpoint_dir, 'state.json'), state)
+
+    save_log_path = state['save_log_path']
+    article_ids = StoredFieldColumns.open(cache.ix, ['articleID'], cache._reader).values('articleID',
+                                                                                       removed_docs_cache)
     fw_cache = open('{}/recur_{}_{}_cache_update_log.csv'
                     .format(save_log_path, cache.name, disk.name), 'w')
     fw_disk = open('{}/recur_{}_{}_disk_update_log.csv'
                    .format(save_log_path, cache.name, disk.name), 'w')
-    for dn in removed_docs_cache:
-        fw_cache.write('d, {}, {}, {}\n'.format(dn, 'void', -1.0))
-        fw_disk.write('a, {}, {}, {}\n'.format(dn, 'void', -1.0))
+    for articleId in article_ids:
+        fw_cache.write('d, {}, {}, {}\n'.format(articleId, 'void', -1.0))
+        fw_disk.write('a, {}, {}, {}\n'.format(articleId, 'void', -1.0))
     fw_cache.close()
     fw_disk.close()
 
 
+def _save_round(checkpoint_dir: str, cache: pt.IndexVirtualPartition, state: dict, removed_docs_cache: list):
+    """Files of a round are complete before state.json points to them; the previous round's are then dropped.
+    disk does not change in the rounds, so it is saved once at the start."""
+    step = state['round']
+    cache.save_state(os.path.join(checkpoint_dir, 'cache_r{}.npz'.format(step)))
+    np.save(os.path.join(checkpoint_dir, 'removed_r{}.npy'.format(step)), np.array(removed_docs_cache, dtype=np.int64))
+    _write_json(os.path.join(checkpoint_dir, 'state.json'), state)
+    for name in ['cache_r{}.npz', 'removed_r{}.npy']:
+        previous = os.path.join(checkpoint_dir, name.format(step - 1))
+        if os.path.exists(previous):
+            os.remove(previous)
+    LOGGER.info('Round {} checkpoint saved in {}'.format(step, checkpoint_dir))
+
+
+def _load_partitions(checkpoint_dir: str, cache_name: str, file_index: index.FileIndex, ix_reader: IndexReader=None):
+    forward_index = ForwardIndex.open(file_index)
+    cache = pt.IndexVirtualPartition.load_state(file_index, os.path.join(checkpoint_dir, cache_name), ix_reader,
+                                                forward_index=forward_index)
+    disk = pt.IndexVirtualPartition.load_state(file_index, os.path.join(checkpoint_dir, 'disk.npz'), ix_reader,
+                                               vocabulary=cache.get_vocabulary(), forward_index=forward_index)
+    return cache, disk
+
+
+def _write_json(file_path: str, obj):
+    with open(file_path + '.tmp', 'w') as fw:
+        json.dump(obj, fw)
+    os.replace(file_path + '.tmp', file_path)
+
+
+def _read_json(file_path: str):
+    with open(file_path, 'r') as fo:
+        return json.load(fo)
+
+
+def _smallest(values: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k smallest values in increasing order, NaNs last, ties in the order of their positions:
+    the first k of a stable sort, found by partial selection"""
+    values = np.asarray(values, dtype=np.float64)
+    k = min(k, len(values))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    nans = np.isnan(values)
+    valid = np.flatnonzero(~nans)
+    if k >= len(valid):
+        order = valid[np.argsort(values[valid], kind='mergesort')]
+        return np.concatenate([order, np.flatnonzero(nans)[:k - len(valid)]])
+    kth = np.partition(values[valid], k - 1)[k - 1]
+    below = valid[values[valid] < kth]
+    chosen = np.concatenate([below, valid[values[valid] == kth][:k - len(below)]])
+    return chosen[np.argsort(values[chosen], kind='mergesort')]
+
+
+def _write_update_logs(cache_log_path: str, disk_log_path: str, to_disk: tuple, to_cache: tuple):
+    """Writes each update log at once. to_disk and to_cache are (articleIds, xpaths, values for the cache log,
+    values for the disk log) of the rows that leave the cache and of those that enter it"""
+    cache_lines, disk_lines = [], []
+    for (ids, xpaths, cache_values, disk_values), (cache_op, disk_op) in [(to_disk, ('d', 'a')),
+                                                                           (to_cache, ('a', 'd'))]:
+        cache_lines += ['{}, {}, {}, {}\n'.format(cache_op, a, x, v) for a, x, v in zip(ids, xpaths, cache_values)]
+        disk_lines += ['{}, {}, {}, {}\n'.format(disk_op, a, x, v) for a, x, v in zip(ids, xpaths, disk_values)]
+    with open(cache_log_path, 'w') as fw:
+        fw.write(''.join(cache_lines))
+    with open(disk_log_path, 'w') as fw:
+        fw.write(''.join(disk_lines))
+
+
+def _rows(df: pd.DataFrame, positions: np.ndarray, cache_col: str, disk_col: str) -> tuple:
+    return (df['articleId'].values[positions].tolist(), df['xpath'].values[positions].tolist(),
+            df[cache_col].values[positions].tolist(), df[disk_col].values[positions].tolist())
+
+
 def naive1(cache_distribution_path: str, disk_distribution_path: str, save_log_path: str, use_column_with_index: int,
            cache_start_range: float, cache_end_range: float,
            disk_start_range: float, disk_end_range: float,
@@ -88,40 +361,34 @@ def naive1(cache_distribution_path: str, disk_distribution_path: str, save_log_p
     disk_df = load_distribution_csv(disk_distribution_path, 
                                     start_range=disk_start_range, end_range=disk_end_range)
     #  0.0 <= cache_start_range, disk_start_range <= cache_end_range, disk_end_range <= 1.0
-    
-    pivot_col = cache_df.columns[use_column_with_index]
+    _naive1(cache_df, disk_df, cache_distribution_path, disk_distribution_path, save_log_path, use_column_with_index,
+            (cache_start_range, cache_end_range), (disk_start_range, disk_end_range), equal_add_delete)
+
 
-    cache_remove_df = cache_df[cache_df[pivot_col] < 0.0]
-    disk_remove_df = disk_df[disk_df[pivot_col] < 0.0]
-    cache_remove_df = cache_remove_df.sort_values(by=pivot_col, ascending=True)
-    disk_remove_df = disk_remove_df.sort_values(by=pivot_col, ascending=True)
+def _naive1(cache_df: pd.DataFrame, disk_df: pd.DataFrame, cache_distribution_path: str, disk_distribution_path: str,
+            save_log_path: str, use_column_with_index: int, cache_range: tuple, disk_range: tuple,
+            equal_add_delete: bool):
+    pivot_col = cache_df.columns[use_column_with_index]
+    cache_values = cache_df[pivot_col].values.astype(np.float64)
+    disk_values = disk_df[pivot_col].values.astype(np.float64)
+    cache_remove = np.flatnonzero(cache_values < 0.0)
+    disk_remove = np.flatnonzero(disk_values < 0.0)
     LOGGER.info('Naive1, {}, eq={}, CaS={}, CaE={}, DiS={}, DiE={}, CaPath:{}, DiPath:{}'
-                .format(pivot_col, equal_add_delete, cache_start_range, cache_end_range,
-                        disk_start_range, disk_end_range, cache_distribution_path, disk_distribution_path))
+                .format(pivot_col, equal_add_delete, cache_range[0], cache_range[1],
+                        disk_range[0], disk_range[1], cache_distribution_path, disk_distribution_path))
     save_log_path = save_log_path[:-1] if save_log_path[-1] == '/' else save_log_path
-    fw_cache = open('{}/niv1_{}_{}-{}_{}-{}_cache_update_log.csv'
-                    .format(save_log_path, pivot_col, cache_start_range, cache_end_range, disk_start_range, disk_end_range), 'w')
-    fw_disk = open('{}/niv1_{}_{}-{}_{}-{}_disk_update_log.csv'
-                   .format(save_log_path, pivot_col, cache_start_range, cache_end_range, disk_start_range, disk_end_range), 'w')
-
-    min_change = cache_remove_df.shape[0] if cache_remove_df.shape[0] < disk_remove_df.shape[0] else disk_remove_df.shape[0]
-    c = 0
-    for _, row in cache_remove_df.iterrows():
-        c += 1
-        fw_cache.write('d, {}, {}, {}\n'.format(row['articleId'], row['xpath'], row[pivot_col]))
-        fw_disk.write('a, {}, {}, {}\n'.format(row['articleId'], row['xpath'], row[pivot_col]))
-        if equal_add_delete and c >= min_change:
-            break
-    c = 0
-    for _, row in disk_remove_df.iterrows():
-        c += 1
-        fw_cache.write('a, {}, {}, {}\n'.format(row['articleId'], row['xpath'], row[pivot_col]))
-        fw_disk.write('d, {}, {}, {}\n'.format(row['articleId'], row['xpath'], row[pivot_col]))
-        if equal_add_delete and c >= min_change:
-            break
+    log_path = '{}/niv1_{}_{}-{}_{}-{}_{{}}_update_log.csv'.format(save_log_path, pivot_col, cache_range[0],
+                                                                    cache_range[1], disk_range[0], disk_range[1])
 
-    fw_cache.close()
-    fw_disk.close()
+    # as many of each side as the smaller side has (at least one) when the changes are equal
+    min_change = max(min(len(cache_remove), len(disk_remove)), 1)
+    cache_rows = cache_remove[_smallest(cache_values[cache_remove],
+                                        min_change if equal_add_delete else len(cache_remove))]
+    disk_rows = disk_remove[_smallest(disk_values[disk_remove],
+                                      min_change if equal_add_delete else len(disk_remove))]
+    _write_update_logs(log_path.format('cache'), log_path.format('disk'),
+                       _rows(cache_df, cache_rows, pivot_col, pivot_col),
+                       _rows(disk_df, disk_rows, pivot_col, pivot_col))
 
 
 def naive2(cache_distribution_path: str, disk_distribution_path: str, save_log_path: str, change_fraction: float,
@@ -133,38 +400,54 @@ def naive2(cache_distribution_path: str, disk_distribution_path: str, save_log_p
     disk_df = load_distribution_csv(disk_distribution_path,
                                     start_range=disk_start_range, end_range=disk_end_range)
     #  0.0 <= cache_start_range, disk_start_range <= cache_end_range, disk_end_range <= 1.0
+    _naive2(cache_df, disk_df, cache_distribution_path, disk_distribution_path, save_log_path, change_fraction,
+            (cache_start_range, cache_end_range), (disk_start_range, disk_end_range), equal_add_delete)
+
 
+def _naive2(cache_df: pd.DataFrame, disk_df: pd.DataFrame, cache_distribution_path: str, disk_distribution_path: str,
+            save_log_path: str, change_fraction: float, cache_range: tuple, disk_range: tuple,
+            equal_add_delete: bool):
     div_col = cache_df.columns[4]
     div_cross_col = cache_df.columns[3]
-
-    # disk_remove_df = disk_df[disk_df[pivot_col] < 0.0]
-    cache_df = cache_df.sort_values(by=div_col, ascending=True)
-    disk_df = disk_df.sort_values(by=div_cross_col, ascending=False)
     LOGGER.info('Naive2-variety, {}, eq={}, CaS={}, CaE={}, DiS={}, DiE={}, CaPath:{}, DiPath:{}'
-                .format(div_col, equal_add_delete, cache_start_range, cache_end_range,
-                        disk_start_range, disk_end_range, cache_distribution_path, disk_distribution_path))
+                .format(div_col, equal_add_delete, cache_range[0], cache_range[1],
+                        disk_range[0], disk_range[1], cache_distribution_path, disk_distribution_path))
     save_log_path = save_log_path[:-1] if save_log_path[-1] == '/' else save_log_path
-    fw_cache = open('{}/niv2_{}_{}-{}_{}-{}_cache_update_log.csv'
-                    .format(save_log_path, div_col, cache_start_range, cache_end_range, disk_start_range,
-                            disk_end_range), 'w')
-    fw_disk = open('{}/niv2_{}_{}-{}_{}-{}_disk_update_log.csv'
-                   .format(save_log_path, div_col, cache_start_range, cache_end_range, disk_start_range,
-                           disk_end_range), 'w')
-
-    c = 0
-    for _, row in cache_df.iterrows():
-        c += 1
-        fw_cache.write('d, {}, {}, {}\n'.format(row['articleId'], row['xpath'], row[div_col]))
-        fw_disk.write('a, {}, {}, {}\n'.format(row['articleId'], row['xpath'], row[div_cross_col]))
-        if equal_add_delete and c >= int(cache_df.shape[0]*change_fraction):
-            break
-    c = 0
-    for _, row in disk_df.iterrows():
-        c += 1
-        fw_cache.write('a, {}, {}, {}\n'.format(row['articleId'], row['xpath'], row[div_cross_col]))
-        fw_disk.write('d, {}, {}, {}\n'.format(row['articleId'], row['xpath'], row[div_col]))
-        if equal_add_delete and c >= int(cache_df.shape[0]*change_fraction):
-            break
+    log_path = '{}/niv2_{}_{}-{}_{}-{}_{{}}_update_log.csv'.format(save_log_path, div_col, cache_range[0],
+                                                                    cache_range[1], disk_range[0], disk_range[1])
 
-    fw_cache.close()
-    fw_disk.close()
+    # the lowest divergences of the cache and the highest cross divergences of the disk,
+    # change_fraction of the cache (at least one) of each when the changes are equal
+    change = max(int(cache_df.shape[0] * change_fraction), 1)
+    cache_rows = _smallest(cache_df[div_col].values, change if equal_add_delete else cache_df.shape[0])
+    disk_rows = _smallest(-disk_df[div_cross_col].values.astype(np.float64),
+                          change if equal_add_delete else disk_df.shape[0])
+    _write_update_logs(log_path.format('cache'), log_path.format('disk'),
+                       _rows(cache_df, cache_rows, div_col, div_cross_col),
+                       _rows(disk_df, disk_rows, div_cross_col, div_col))
+
+
+def naive_sweep(solution: str, cache_distribution_path: str, disk_distribution_path: str, save_log_path: str,
+                cache_ranges: list, disk_ranges: list, change_fractions: list=None, use_column_with_index: int=2,
+                equal_add_delete: bool=True):
+    """naive1 or naive2 for every (cache range, disk range) pair, and every change fraction for naive2,
+    with each distribution loaded once; the update logs are those of the separate calls"""
+    if solution not in ('naive1', 'naive2'):
+        raise ValueError('Unknown solution {}'.format(solution))
+    if solution == 'naive2' and not change_fractions:
+        raise ValueError('naive2 needs change fractions')
+    cache_all = load_distribution_csv(cache_distribution_path)
+    disk_all = load_distribution_csv(disk_distribution_path)
+    for cr in cache_ranges:
+        first, last = _row_range(cache_all.shape[0] + 1, cr[0], cr[1])
+        cache_df = cache_all.iloc[first:last]
+        for dr in disk_ranges:
+            first, last = _row_range(disk_all.shape[0] + 1, dr[0], dr[1])
+            disk_df = disk_all.iloc[first:last]
+            if solution == 'naive1':
+                _naive1(cache_df, disk_df, cache_distribution_path, disk_distribution_path, save_log_path,
+                        use_column_with_index, cr, dr, equal_add_delete)
+                continue
+            for change_fraction in change_fractions:
+                _naive2(cache_df, disk_df, cache_distribution_path, disk_distribution_path, save_log_path,
+                        change_fraction, cr, dr, equal_add_delete)
@@ -0,0 +1,95 @@
+from partition import IndexVirtualPartition
+from fieldcache import ArticleDocnumIndex
+import numpy as np
+import logging
+import time
+
+LOGGER = logging.getLogger()
+
+
+def read_update_log(file_path: str, batch_size: int=100000):
+    """Batches (adds, article_ids) of an update log written by naive1, naive2 or recursive_refine, whose lines
+    are 'a, articleId, xpath, score' or 'd, ...'; adds tells which of the article IDs are added"""
+    adds, article_ids = [], []
+    with open(file_path, 'r') as fo:
+        for line in fo:
+            fields = line.split(',', 2)
+            if len(fields) < 2:
+                continue
+            op = fields[0].strip()
+            if op not in ('a', 'd'):
+                raise ValueError('Unknown update {} in {}'.format(op, file_path))
+            adds.append(op == 'a')
+            article_ids.append(fields[1].strip())
+            if len(article_ids) >= batch_size:
+                yield np.array(adds, dtype=bool), article_ids
+                adds, article_ids = [], []
+    if len(article_ids) > 0:
+        yield np.array(adds, dtype=bool), article_ids
+
+
+class UpdateLogApplier(object):
+    """Applies update logs to existing partitions in batches of add_docs/remove_docs, the article IDs of a batch
+    being resolved to docnums at once. With tf divergences, the divergence of cache from disk is kept up to date
+    from the terms of the moved documents only, so that an update costs as much as the log, not the corpus.
+    Its tracker stays on the partitions until close(), e.g. at the end of a with block."""
+
+    def __init__(self, cache: IndexVirtualPartition, disk: IndexVirtualPartition=None,
+                 similarity_measure_type: str='kld', tolerance: float=1e-3, batch_size: int=100000):
+        self.cache = cache
+        self.disk = disk
+        self.batch_size = batch_size
+        self._lookup = ArticleDocnumIndex.open(cache.ix, cache._reader)
+        self._tracker = cache.track_divergence(disk, similarity_measure_type, tolerance) if disk is not None else None
+
+    def close(self):
+        """detaches the divergence tracker from the partitions"""
+        if self._tracker is not None:
+            self.cache.untrack(self._tracker)
+            self._tracker = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def divergence(self) -> float:
+        """tf divergence of cache from disk, or None without a disk"""
+        return self._tracker.value() if self._tracker is not None else None
+
+    def apply(self, cache_log_path: str, disk_log_path: str=None) -> dict:
+        """Applies the cache update log to cache and, if given, the disk update log to disk"""
+        st = time.time()
+        stats = self._apply(self.cache, cache_log_path)
+        if disk_log_path is not None:
+            if self.disk is None:
+                raise ValueError('No disk partition for {}'.format(disk_log_path))
+            for k, v in self._apply(self.disk, disk_log_path).items():
+                stats['disk_' + k] = v
+        stats['divergence'] = self.divergence()
+        LOGGER.info('Update log {} applied: {} [{:.2f}s]'.format(cache_log_path, stats, time.time() - st))
+        return stats
+
+    def _apply(self, partition: IndexVirtualPartition, log_path: str) -> dict:
+        stats = {'added': 0, 'removed': 0, 'unresolved': 0}
+        for adds, article_ids in read_update_log(log_path, self.batch_size):
+            docnums = self._lookup.docnums(article_ids)
+            resolved = docnums >= 0
+            stats['unresolved'] += int((~resolved).sum())
+            docnums, adds = docnums[resolved], adds[resolved]
+            # the last update of a document in the batch is the one that holds
+            last = len(docnums) - 1 - np.unique(docnums[::-1], return_index=True)[1]
+            docnums, adds = docnums[last], adds[last]
+            before = partition.doc_count()
+            partition.remove_docs(docnums[~adds])
+            removed = before - partition.doc_count()
+            partition.add_docs(docnums[adds])
+            stats['removed'] += removed
+            stats['added'] += partition.doc_count() - before + removed
+            if self._tracker is not None:
+                LOGGER.info('{}: {} updates applied, divergence({}, {}) = {}'
+                            .format(log_path, len(article_ids), self.cache.name, self.disk.name, self.divergence()))
+        if stats['unresolved'] > 0:
+            LOGGER.warning('{} article IDs of {} are not in the index'.format(stats['unresolved'], log_path))
+        return stats
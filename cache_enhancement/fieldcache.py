@@ -0,0 +1,261 @@
+from whoosh import index, columns
+from whoosh.reading import IndexReader
+import numpy as np
+import shutil
+import config
+import logging
+import json
+import time
+import os
+
+LOGGER = logging.getLogger()
+
+_ARTICLE_DOCNUMS = {}
+_STORED_COLUMNS = {}
+# stored fields that are extracted as columns by default
+STORED_COLUMNS = ['articleID', 'count', 'xpath']
+
+
+class ArticleDocnumIndex(object):
+    """articleID -> docnum lookup of an index, built from the postings of the articleID field.
+    Keys are kept sorted (utf-8 bytes) so that a whole list of IDs is resolved with one binary search each.
+    It is saved next to the index and rebuilt when the index generation changes."""
+
+    def __init__(self, keys: np.ndarray, docnums: np.ndarray, generation: int):
+        self._keys = keys
+        self._docnums = docnums
+        self.generation = generation
+
+    @classmethod
+    def from_reader(cls, ix_reader: IndexReader, generation: int=-1, fieldname='articleID'):
+        st = time.time()
+        keys, docnums = [], []
+        for text, _ in ix_reader.iter_field(fieldname):
+            dns = list(ix_reader.postings(fieldname, text).all_ids())
+            if len(dns) == 0:
+                continue
+            if len(dns) > 1:
+                LOGGER.warning('Article ID {} has multiple instances in the index'.format(text))
+            keys.append(text)
+            docnums.append(min(dns))
+        # the term dictionary is sorted by bytes already
+        lookup = cls(np.array(keys, dtype=bytes) if len(keys) > 0 else np.zeros(0, dtype='S1'),
+                     np.array(docnums, dtype=np.int64), generation)
+        LOGGER.info('articleID lookup of {} documents built. [{:.1f}s]'.format(len(keys), time.time() - st))
+        return lookup
+
+    @classmethod
+    def open(cls, file_index: index.FileIndex, ix_reader: IndexReader=None):
+        """The lookup of the current generation of the index, from memory, from disk or built (and saved)"""
+        path = config.index_sidecar_path(file_index, 'articleid_docnum')
+        generation = file_index.latest_generation()
+        key = (path, generation)
+        if key in _ARTICLE_DOCNUMS:
+            return _ARTICLE_DOCNUMS[key]
+        lookup = None
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            with open(os.path.join(path, 'meta.json'), 'r') as fo:
+                if json.load(fo)['generation'] == generation:
+                    lookup = cls(np.load(os.path.join(path, 'keys.npy'), mmap_mode='r'),
+                                 np.load(os.path.join(path, 'docnums.npy'), mmap_mode='r'), generation)
+        if lookup is None:
+            if ix_reader is not None:
+                lookup = cls.from_reader(ix_reader, generation)
+            else:
+                with file_index.reader() as r:
+                    lookup = cls.from_reader(r, generation)
+            lookup.save(path)
+        _ARTICLE_DOCNUMS[key] = lookup
+        return lookup
+
+    def save(self, path: str):
+        tmp_path = path + '.tmp'
+        try:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+            os.makedirs(tmp_path)
+            np.save(os.path.join(tmp_path, 'keys.npy'), self._keys)
+            np.save(os.path.join(tmp_path, 'docnums.npy'), self._docnums)
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as fw:
+                json.dump({'generation': self.generation}, fw)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+        except OSError as e:
+            LOGGER.warning('articleID lookup could not be saved in {}: {}'.format(path, e))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def docnums(self, article_ids: list) -> np.ndarray:
+        """docnums of the article IDs, -1 for the IDs that are not in the index"""
+        if len(article_ids) == 0 or len(self._keys) == 0:
+            return np.full(len(article_ids), -1, dtype=np.int64)
+        ids = np.array([str(a).encode('utf-8') for a in article_ids], dtype=bytes)
+        pos = np.minimum(np.searchsorted(self._keys, ids), len(self._keys) - 1)
+        return np.where(self._keys[pos] == ids, self._docnums[pos], -1)
+
+    def docnum(self, article_id) -> int:
+        return int(self.docnums([article_id])[0])
+
+
+def pack_strings(strings) -> tuple:
+    """(offsets, data) of strings as one utf-8 buffer; string i is data[offsets[i]:offsets[i+1]]"""
+    encoded = [v.encode('utf-8') for v in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def unpack_strings(offsets: np.ndarray, data: np.ndarray, positions) -> list:
+    """the strings at the given positions of a buffer made by pack_strings"""
+    positions = np.asarray(positions, dtype=np.int64)
+    starts, ends = offsets[positions].tolist(), offsets[positions + 1].tolist()
+    buffer = memoryview(data)
+    return [str(buffer[s:e], 'utf-8') for s, e in zip(starts, ends)]
+
+
+class StoredFieldColumns(object):
+    """Stored fields of an index as per-docnum columns, extracted in one pass over the stored fields so that the
+    fields of many documents are read without decompressing their records. Integer fields are int64 arrays and
+    the others are strings in a single utf-8 buffer indexed by offsets. The columns are saved next to the index
+    and rebuilt when the index generation changes. Deleted documents (and missing values) read as None."""
+
+    def __init__(self, doc_count_all: int, generation: int, path: str=None):
+        self._columns = {}
+        self.doc_count_all = doc_count_all
+        self.generation = generation
+        self.path = path
+
+    @classmethod
+    def open(cls, file_index: index.FileIndex, fieldnames: list=STORED_COLUMNS, ix_reader: IndexReader=None):
+        """The columns of the current generation of the index, with (at least) the given fields,
+        from memory, from disk or extracted (and saved)"""
+        path = config.index_sidecar_path(file_index, 'stored_columns')
+        key = (path, file_index.latest_generation())
+        if key not in _STORED_COLUMNS:
+            _STORED_COLUMNS[key] = cls._load(path, key[1])
+        stored_columns = _STORED_COLUMNS[key]
+        missing = [f for f in fieldnames if f not in stored_columns._columns]
+        if len(missing) > 0:
+            # the default fields come in the same pass, which costs the same
+            missing += [f for f in STORED_COLUMNS if f not in stored_columns._columns and f not in missing]
+            if ix_reader is not None:
+                stored_columns.read(ix_reader, missing)
+            else:
+                with file_index.reader() as r:
+                    stored_columns.read(r, missing)
+            stored_columns.save(missing)
+        return stored_columns
+
+    @classmethod
+    def _load(cls, path: str, generation: int):
+        meta = None
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            with open(os.path.join(path, 'meta.json'), 'r') as fo:
+                meta = json.load(fo)
+            if meta['generation'] != generation:
+                LOGGER.info('Stored field columns in {} are stale (generation {} != {})'
+                            .format(path, meta['generation'], generation))
+                shutil.rmtree(path, ignore_errors=True)
+                meta = None
+        if meta is None:
+            return cls(-1, generation, path)
+        stored_columns = cls(meta['doc_count_all'], generation, path)
+        for f, kind in meta['fields'].items():
+            missing = np.load(os.path.join(path, f + '.missing.npy'), mmap_mode='r')
+            if kind == 'int':
+                stored_columns._columns[f] = ('int', np.load(os.path.join(path, f + '.values.npy'), mmap_mode='r'),
+                                              missing)
+            else:
+                offsets = np.load(os.path.join(path, f + '.offsets.npy'), mmap_mode='r')
+                data = np.memmap(os.path.join(path, f + '.data.bin'), dtype=np.uint8, mode='r') \
+                    if offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+                stored_columns._columns[f] = ('str', (offsets, data), missing)
+        return stored_columns
+
+    def read(self, ix_reader: IndexReader, fieldnames: list):
+        st = time.time()
+        self.doc_count_all = ix_reader.doc_count_all()
+        raw = {f: [None] * self.doc_count_all for f in fieldnames}
+        for dn, fields in ix_reader.iter_docs():
+            for f, column in raw.items():
+                column[dn] = fields.get(f)
+        for f, column in raw.items():
+            missing = np.fromiter((v is None for v in column), dtype=bool, count=self.doc_count_all)
+            if all(type(v) is int for v in column if v is not None):
+                values = np.fromiter((v if v is not None else 0 for v in column), dtype=np.int64,
+                                     count=self.doc_count_all)
+                self._columns[f] = ('int', values, missing)
+            else:
+                self._columns[f] = ('str', pack_strings(str(v) if v is not None else '' for v in column), missing)
+        LOGGER.info('Stored field columns {} extracted. [{:.1f}s]'.format(fieldnames, time.time() - st))
+
+    def save(self, fieldnames: list):
+        """Writes the columns of the fields; meta.json is rewritten last to list them"""
+        if self.path is None:
+            return
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            for f in fieldnames:
+                kind, values, missing = self._columns[f]
+                np.save(os.path.join(self.path, f + '.missing.npy'), missing)
+                if kind == 'int':
+                    np.save(os.path.join(self.path, f + '.values.npy'), values)
+                else:
+                    np.save(os.path.join(self.path, f + '.offsets.npy'), values[0])
+                    values[1].tofile(os.path.join(self.path, f + '.data.bin'))
+            with open(os.path.join(self.path, 'meta.json.tmp'), 'w') as fw:
+                json.dump({'generation': self.generation, 'doc_count_all': self.doc_count_all,
+                           'fields': {f: c[0] for f, c in self._columns.items()}}, fw)
+            os.replace(os.path.join(self.path, 'meta.json.tmp'), os.path.join(self.path, 'meta.json'))
+        except OSError as e:
+            LOGGER.warning('Stored field columns could not be saved in {}: {}'.format(self.path, e))
+
+    def column(self, fieldname: str) -> np.ndarray:
+        """the values of an integer field for every docnum (0 where it is missing)"""
+        kind, values, _ = self._columns[fieldname]
+        if kind != 'int':
+            raise TypeError('{} is not an integer column'.format(fieldname))
+        return values
+
+    def values(self, fieldname: str, docnums) -> list:
+        """values of the field for the docnums, in the given order"""
+        kind, values, missing = self._columns[fieldname]
+        docnums = np.asarray(docnums, dtype=np.int64)
+        if kind == 'int':
+            found = values[docnums].tolist()
+        else:
+            found = unpack_strings(values[0], values[1], docnums)
+        return [v if not m else None for v, m in zip(found, missing[docnums].tolist())]
+
+
+# private attributes of whoosh's NumericColumn.Reader read by numeric_column; without them it reads the values
+_RAW_COLUMN_ATTRS = ('_dbfile', '_basepos', '_count', '_fixedlen', '_typecode', '_default')
+
+
+def numeric_column(ix_reader: IndexReader, fieldname: str) -> np.ndarray:
+    """Values of a sortable NUMERIC field for every docnum of the reader (deleted documents included),
+    read from the column of each segment rather than from the stored fields"""
+    fieldobj = ix_reader.schema[fieldname]
+    if fieldobj.numtype is not int or fieldobj.decimal_places != 0:
+        return np.fromiter(ix_reader.column_reader(fieldname), dtype=np.float64, count=ix_reader.doc_count_all())
+    if fieldobj.bits > 32:
+        # 64-bit values do not fit the int64 arithmetic of the raw read
+        return np.fromiter(ix_reader.column_reader(fieldname), dtype=np.int64 if fieldobj.signed else np.uint64,
+                           count=ix_reader.doc_count_all())
+    values = np.zeros(ix_reader.doc_count_all(), dtype=np.int64)
+    for reader, offset in ix_reader.leaf_readers():
+        doc_count = reader.doc_count_all()
+        column = reader.column_reader(fieldname, translate=False)
+        if isinstance(column, columns.NumericColumn.Reader) and all(hasattr(column, a) for a in _RAW_COLUMN_ATTRS):
+            # fixed-size big-endian values up to the last non-default one; the rest are the default
+            raw = column._dbfile.get(column._basepos, column._count * column._fixedlen)
+            stored = np.frombuffer(raw, dtype='>' + column._typecode)
+            values[offset:offset + doc_count] = column._default
+            values[offset:offset + len(stored)] = stored
+        else:
+            values[offset:offset + doc_count] = np.fromiter(column, dtype=np.int64, count=doc_count)
+    if fieldobj.signed:
+        values -= 1 << (fieldobj.bits - 1)
+    return values
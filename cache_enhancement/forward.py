@@ -0,0 +1,188 @@
+from whoosh import index
+from termstats import TermVocabulary
+import numpy as np
+import multiprocessing
+import tempfile
+import shutil
+import config
+import logging
+import json
+import time
+import sys
+import os
+
+LOGGER = logging.getLogger()
+
+_VOCABULARIES = {}
+
+
+class ForwardIndex(object):
+    """Memory-mapped CSR snapshot of the term vectors of one field of an index.
+    The vector of docnum d is term_ids[offsets[d]:offsets[d+1]] with the frequencies at the same positions
+    of freqs; term ids refer to the vocabulary stored with the snapshot. Docnums without a vector (including
+    deleted documents) have an empty row."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as fo:
+            meta = json.load(fo)
+        self.fieldname = meta['fieldname']
+        self.generation = meta['generation']
+        self._offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        nnz = int(self._offsets[-1])
+        self._term_ids = np.memmap(os.path.join(path, 'term_ids.bin'), dtype=np.int32, mode='r', shape=(nnz,)) \
+            if nnz > 0 else np.zeros(0, dtype=np.int32)
+        self._freqs = np.memmap(os.path.join(path, 'freqs.bin'), dtype=np.int32, mode='r', shape=(nnz,)) \
+            if nnz > 0 else np.zeros(0, dtype=np.int32)
+        self._vocabulary = None
+
+    @classmethod
+    def open(cls, file_index: index.FileIndex, fieldname='body'):
+        """The snapshot of the field if it exists and is up to date with the index, otherwise None"""
+        path = config.index_sidecar_path(file_index, 'forward_' + fieldname)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return None
+        fwd = cls(path)
+        if fwd.generation != file_index.latest_generation():
+            LOGGER.warning('Forward index {} is stale (generation {} != {}). It is ignored.'
+                           .format(path, fwd.generation, file_index.latest_generation()))
+            return None
+        return fwd
+
+    @property
+    def vocabulary(self) -> TermVocabulary:
+        if self._vocabulary is None:
+            key = (self.path, self.generation)
+            if key not in _VOCABULARIES:
+                with open(os.path.join(self.path, 'vocabulary.txt'), 'r', encoding='utf-8') as fo:
+                    _VOCABULARIES[key] = TermVocabulary([l[:-1] for l in fo])
+            self._vocabulary = _VOCABULARIES[key]
+        return self._vocabulary
+
+    def doc_count_all(self):
+        return len(self._offsets) - 1
+
+    def has_vector(self, docnum):
+        return self._offsets[docnum + 1] > self._offsets[docnum]
+
+    def vector(self, docnum):
+        """(term ids, frequencies) of a document as views on the mapped arrays"""
+        st, en = self._offsets[docnum], self._offsets[docnum + 1]
+        return self._term_ids[st:en], self._freqs[st:en]
+
+    def doc_lengths(self, docnums) -> np.ndarray:
+        """number of distinct terms in the vectors of the documents"""
+        docnums = np.asarray(docnums, dtype=np.int64)
+        return self._offsets[docnums + 1] - self._offsets[docnums]
+
+    def rows(self, docnums):
+        """Gathers the vectors of the documents, in the given order, into CSR arrays (indptr, term_ids, freqs)"""
+        docnums = np.asarray(docnums, dtype=np.int64)
+        starts = self._offsets[docnums]
+        lengths = self._offsets[docnums + 1] - starts
+        indptr = np.zeros(len(docnums) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1], dtype=np.int64)
+        return indptr, self._term_ids[positions], self._freqs[positions]
+
+    def term_counts(self, docnums, chunk_size=100000):
+        """(dfs, tfs, total terms) of a set of documents as vectors aligned with the vocabulary term ids"""
+        size = len(self.vocabulary)
+        tfs = np.zeros(size, dtype=np.int64)
+        dfs = np.zeros(size, dtype=np.int64)
+        docnums = np.asarray(docnums, dtype=np.int64)
+        for st in range(0, len(docnums), chunk_size):
+            _, term_ids, freqs = self.rows(docnums[st:st + chunk_size])
+            tfs += np.bincount(term_ids, weights=freqs, minlength=size).astype(np.int64)
+            dfs += np.bincount(term_ids, minlength=size)
+        return dfs, tfs, int(tfs.sum())
+
+    def grouped_term_counts(self, labels: np.ndarray, groups: int, start: int=0, end: int=None,
+                            chunk_size=100000):
+        """(dfs, tfs) of several disjoint groups of documents, as (groups x vocabulary) arrays, in one sequential
+        pass over the rows of the docnums [start, end). labels[d] is the group of docnum d, or -1 for none."""
+        size = len(self.vocabulary)
+        end = self.doc_count_all() if end is None else end
+        tfs = np.zeros(groups * size, dtype=np.int64)
+        dfs = np.zeros(groups * size, dtype=np.int64)
+        for st in range(start, end, chunk_size):
+            en = min(st + chunk_size, end)
+            # the rows of consecutive docnums are contiguous in the mapped arrays
+            lo, hi = self._offsets[st], self._offsets[en]
+            entry_labels = np.repeat(np.asarray(labels[st:en], dtype=np.int64), np.diff(self._offsets[st:en + 1]))
+            keep = entry_labels >= 0
+            keys = entry_labels[keep] * size + self._term_ids[lo:hi][keep]
+            tfs += np.bincount(keys, weights=self._freqs[lo:hi][keep], minlength=groups * size).astype(np.int64)
+            dfs += np.bincount(keys, minlength=groups * size)
+        return dfs.reshape(groups, size), tfs.reshape(groups, size)
+
+    def partition_term_counts(self, labels: np.ndarray, groups: int, procs: int=1) -> list:
+        """(dfs, tfs, total terms) of every group of documents, like term_counts, from one scan of the snapshot.
+        With procs > 1 the docnums are split into ranges counted by a pool of workers and summed at the end."""
+        if procs > 1:
+            bounds = np.linspace(0, self.doc_count_all(), procs + 1).astype(np.int64)
+            shared_dir = tempfile.mkdtemp(prefix='partition_term_counts_')
+            try:
+                labels_path = os.path.join(shared_dir, 'labels.npy')
+                np.save(labels_path, labels)
+                tasks = [(self.path, labels_path, groups, int(bounds[i]), int(bounds[i + 1])) for i in range(procs)]
+                with multiprocessing.Pool(procs) as pool:
+                    results = pool.map(_grouped_term_counts_worker, tasks, chunksize=1)
+            finally:
+                shutil.rmtree(shared_dir, ignore_errors=True)
+            dfs, tfs = sum(r[0] for r in results), sum(r[1] for r in results)
+        else:
+            dfs, tfs = self.grouped_term_counts(labels, groups)
+        return [(dfs[g], tfs[g], int(tfs[g].sum())) for g in range(groups)]
+
+
+def _grouped_term_counts_worker(task):
+    forward_path, labels_path, groups, start, end = task
+    return ForwardIndex(forward_path).grouped_term_counts(np.load(labels_path, mmap_mode='r'), groups, start, end)
+
+
+def export(file_index: index.FileIndex, fieldname='body', log_step=100000):
+    """Writes the term vectors of a field to a ForwardIndex snapshot next to the index"""
+    path = config.index_sidecar_path(file_index, 'forward_' + fieldname)
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    st = time.time()
+    LOGGER.info('Exporting forward index of [{}] field to {}'.format(fieldname, path))
+    with file_index.reader() as ix_reader:
+        vocabulary = TermVocabulary.from_reader(ix_reader, fieldname)
+        with open(os.path.join(tmp_path, 'vocabulary.txt'), 'w', encoding='utf-8') as fw:
+            for t in vocabulary.terms():
+                fw.write(t + '\n')
+        offsets = np.zeros(ix_reader.doc_count_all() + 1, dtype=np.int64)
+        with open(os.path.join(tmp_path, 'term_ids.bin'), 'wb') as fw_ids, \
+                open(os.path.join(tmp_path, 'freqs.bin'), 'wb') as fw_freqs:
+            for dn in range(ix_reader.doc_count_all()):
+                n = 0
+                if not ix_reader.is_deleted(dn) and ix_reader.has_vector(dn, fieldname):
+                    vector = list(ix_reader.vector_as('frequency', dn, fieldname))
+                    n = len(vector)
+                    vocabulary.ids(t for t, _ in vector).astype(np.int32).tofile(fw_ids)
+                    np.fromiter((f for _, f in vector), dtype=np.int32, count=n).tofile(fw_freqs)
+                offsets[dn + 1] = offsets[dn] + n
+                if (dn + 1) % log_step == 0:
+                    LOGGER.info('{} documents exported [{:.1f} d/s]'.format(dn + 1, (dn + 1) / (time.time() - st)))
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    # meta.json is written last; a snapshot without it is incomplete
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as fw:
+        json.dump({'fieldname': fieldname, 'generation': file_index.latest_generation()}, fw)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    LOGGER.info('Forward index exported. [{:.2f} min]'.format((time.time() - st) / 60))
+    return ForwardIndex(path)
+
+
+if __name__ == '__main__':
+    c = config.get_paths()
+    if len(sys.argv) >= 2:
+        config.setup_logger('{}_forward'.format(sys.argv[1]))
+        export(index.open_dir(c[sys.argv[1]], readonly=True))
+    else:
+        print('index_alias is required!')
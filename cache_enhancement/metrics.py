@@ -1,31 +1,59 @@
 from __future__ import division
-from math import log
+from scipy import sparse
+import numpy as np
 import logging
 
 LOGGER = logging.getLogger()
 
 
+class _NegativeCountError(ValueError):
+    """negative count of the term at a position of aligned vectors"""
+
+    def __init__(self, position: int):
+        super(_NegativeCountError, self).__init__(
+            'Negative count for number of occurences of term {}'.format(position))
+        self.position = position
+
+
+def _aligned(corpus1_measure: dict, corpus2_measure: dict, vocabularies) -> tuple:
+    vocabularies = list(vocabularies)
+    m1 = np.fromiter((corpus1_measure.get(t, 0.0) for t in vocabularies), dtype=np.float64, count=len(vocabularies))
+    m2 = np.fromiter((corpus2_measure.get(t, 0.0) for t in vocabularies), dtype=np.float64, count=len(vocabularies))
+    return m1, m2
+
+
 def kl_divergence(corpus1_measure: dict, corpus2_measure: dict,
                   corpus1_normalization_factor=1.0, corpus2_normalization_factor=1.0) -> float:
     """Xu, Jinxi, and W. Bruce Croft. "Cluster-based language models for distributed retrieval."
     Proceedings of the 22nd annual international ACM SIGIR conference on Research and development in
     information retrieval. ACM, 1999.
     (section 2.3)"""
+    vocabularies = list(corpus1_measure)
+    m1, m2 = _aligned(corpus1_measure, corpus2_measure, vocabularies)
+    try:
+        return kl_divergence_array(m1, m2, corpus1_normalization_factor, corpus2_normalization_factor)
+    except _NegativeCountError as e:
+        # named by its term rather than by its position
+        raise ValueError('Negative count for number of occurences of term {}'
+                         .format(vocabularies[e.position])) from None
+
+
+def kl_divergence_array(corpus1_measure: np.ndarray, corpus2_measure: np.ndarray,
+                        corpus1_normalization_factor=1.0, corpus2_normalization_factor=1.0) -> float:
+    """kl_divergence over aligned vectors: element i of both vectors is the measure of the same term,
+    and the vectors cover the vocabulary of corpus1."""
 
     if corpus1_normalization_factor == 0 or corpus2_normalization_factor == 0:
         LOGGER.warning('KLD 0.0000 for no-term corpus!')
         return 0.0
 
-    kl = 0.0
-    for t in corpus1_measure:
-        sm_w_t_1 = corpus1_measure.get(t, 0.0) + 0.01
-        sm_w_t_2 = corpus2_measure.get(t, 0.0) + 0.01
-        if sm_w_t_1 < 0 or sm_w_t_2 < 0:
-            raise ValueError('Negative count for number of occurences of term {}'.format(t))
-        p_t_c1 = sm_w_t_1 / corpus1_normalization_factor
-        p_t_c2 = (sm_w_t_1 + sm_w_t_2) / (corpus1_normalization_factor + corpus2_normalization_factor)
-        kl += p_t_c1 * log(p_t_c1 / p_t_c2)
-    return kl
+    sm_w_t_1 = np.asarray(corpus1_measure, dtype=np.float64) + 0.01
+    sm_w_t_2 = np.asarray(corpus2_measure, dtype=np.float64) + 0.01
+    if (sm_w_t_1 < 0).any() or (sm_w_t_2 < 0).any():
+        raise _NegativeCountError(int(np.flatnonzero((sm_w_t_1 < 0) | (sm_w_t_2 < 0))[0]))
+    p_t_c1 = sm_w_t_1 / corpus1_normalization_factor
+    p_t_c2 = (sm_w_t_1 + sm_w_t_2) / (corpus1_normalization_factor + corpus2_normalization_factor)
+    return float(np.sum(p_t_c1 * np.log(p_t_c1 / p_t_c2)))
 
 
 def avg_kl_divergence(corpus1_measure: dict, corpus2_measure: dict,
@@ -36,14 +64,69 @@ def avg_kl_divergence(corpus1_measure: dict, corpus2_measure: dict,
     # vocabularies = list(set(corpus1_measure.keys()).union(set(corpus2_measure.keys())))
     # one way comparison for simplicity
     vocabularies = corpus1_measure if len(corpus1_measure) <= len(corpus2_measure) else corpus2_measure
-    avg_kl = 0.0
-    for t in vocabularies:
-        sm_w_t_1 = (corpus1_measure.get(t, 0.0) / corpus1_normalization_factor) + 0.01
-        sm_w_t_2 = (corpus2_measure.get(t, 0.0) / corpus2_normalization_factor) + 0.01
-        pi1 = sm_w_t_1 / (sm_w_t_1 + sm_w_t_2)
-        pi2 = sm_w_t_2 / (sm_w_t_1 + sm_w_t_2)
-        M = pi1 * sm_w_t_1 + pi2 * sm_w_t_2
-        D1 = sm_w_t_1 * log(sm_w_t_1 / M)
-        D2 = sm_w_t_2 * log(sm_w_t_2 / M)
-        avg_kl += pi1 * D1 + pi2 * D2
-    return avg_kl
+    m1, m2 = _aligned(corpus1_measure, corpus2_measure, vocabularies)
+    return avg_kl_divergence_array(m1, m2, corpus1_normalization_factor, corpus2_normalization_factor)
+
+
+def avg_kl_divergence_array(corpus1_measure: np.ndarray, corpus2_measure: np.ndarray,
+                            corpus1_normalization_factor=1.0, corpus2_normalization_factor=1.0) -> float:
+    """avg_kl_divergence over aligned vectors: element i of both vectors is the measure of the same term,
+    and the vectors cover the vocabulary of the corpus with fewer terms."""
+    return float(np.sum(avg_kl_divergence_terms(corpus1_measure, corpus2_measure,
+                                                corpus1_normalization_factor, corpus2_normalization_factor)))
+
+
+def avg_kl_divergence_terms(corpus1_measure: np.ndarray, corpus2_measure: np.ndarray,
+                            corpus1_normalization_factor=1.0, corpus2_normalization_factor=1.0) -> np.ndarray:
+    """contribution of every term to avg_kl_divergence_array"""
+    sm_w_t_1 = (np.asarray(corpus1_measure, dtype=np.float64) / corpus1_normalization_factor) + 0.01
+    sm_w_t_2 = (np.asarray(corpus2_measure, dtype=np.float64) / corpus2_normalization_factor) + 0.01
+    pi1 = sm_w_t_1 / (sm_w_t_1 + sm_w_t_2)
+    pi2 = sm_w_t_2 / (sm_w_t_1 + sm_w_t_2)
+    M = pi1 * sm_w_t_1 + pi2 * sm_w_t_2
+    D1 = sm_w_t_1 * np.log(sm_w_t_1 / M)
+    D2 = sm_w_t_2 * np.log(sm_w_t_2 / M)
+    return pi1 * D1 + pi2 * D2
+
+
+def _rows_normalization(rows_measure: sparse.csr_matrix, rows_normalization_factor) -> np.ndarray:
+    # normalization factor of the row of every stored entry
+    return np.repeat(np.asarray(rows_normalization_factor, dtype=np.float64), np.diff(rows_measure.indptr))
+
+
+def _sum_rows(rows_measure: sparse.csr_matrix, values: np.ndarray) -> np.ndarray:
+    return np.asarray(sparse.csr_matrix((values, rows_measure.indices, rows_measure.indptr),
+                                        shape=rows_measure.shape).sum(axis=1)).ravel()
+
+
+def kl_divergence_rows(rows_measure: sparse.csr_matrix, corpus2_measure: np.ndarray,
+                       rows_normalization_factor: np.ndarray, corpus2_normalization_factor=1.0) -> np.ndarray:
+    """kl_divergence of every row of a (document x term) matrix from one corpus, in one pass.
+    The stored entries of a row are the vocabulary of that row (corpus1), and corpus2_measure is a vector
+    indexed by the matrix columns (term ids)."""
+    if corpus2_normalization_factor == 0:
+        LOGGER.warning('KLD 0.0000 for no-term corpus!')
+        return np.zeros(rows_measure.shape[0])
+
+    n1 = _rows_normalization(rows_measure, rows_normalization_factor)
+    sm_w_t_1 = rows_measure.data.astype(np.float64) + 0.01
+    sm_w_t_2 = np.asarray(corpus2_measure, dtype=np.float64)[rows_measure.indices] + 0.01
+    if (sm_w_t_1 < 0).any() or (sm_w_t_2 < 0).any():
+        t = rows_measure.indices[np.flatnonzero((sm_w_t_1 < 0) | (sm_w_t_2 < 0))[0]]
+        raise ValueError('Negative count for number of occurences of term {}'.format(t))
+    # rows without terms are left to 0.0 as in kl_divergence
+    n1[n1 == 0] = np.inf
+    p_t_c1 = sm_w_t_1 / n1
+    p_t_c2 = (sm_w_t_1 + sm_w_t_2) / (n1 + corpus2_normalization_factor)
+    return _sum_rows(rows_measure, p_t_c1 * np.log(p_t_c1 / p_t_c2))
+
+
+def avg_kl_divergence_rows(rows_measure: sparse.csr_matrix, corpus2_measure: np.ndarray,
+                           rows_normalization_factor: np.ndarray, corpus2_normalization_factor=1.0) -> np.ndarray:
+    """avg_kl_divergence of every row of a (document x term) matrix from one corpus, in one pass.
+    The comparison is over the stored entries of each row, so a row is expected to have fewer terms
+    than the corpus."""
+    n1 = _rows_normalization(rows_measure, rows_normalization_factor)
+    return _sum_rows(rows_measure, avg_kl_divergence_terms(rows_measure.data,
+                                                           np.asarray(corpus2_measure)[rows_measure.indices],
+                                                           n1, corpus2_normalization_factor))
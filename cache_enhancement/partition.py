@@ -4,13 +4,28 @@ from whoosh.searching import Searcher
 from whoosh import sorting
 from whoosh.qparser import QueryParser
 from collections import defaultdict
+from termstats import TermVocabulary, TermCountView, TermScoreView
+from forward import ForwardIndex
+from resultcache import ResultCache, SHARED_CACHE
+from bitmap import DocnumBitmap
+from fieldcache import numeric_column
+from scipy import sparse
+import itertools
+import numpy as np
 import metrics as mt
-from math import log
+from math import log, ceil
+import multiprocessing
+import tempfile
+import shutil
+import config
 import logging
 import time
+import os
 
 LOGGER = logging.getLogger()
 
+_partition_ids = itertools.count()
+
 
 def get_database_tfs(ix_reader: MultiReader, field_name='body'):
     LOGGER.info('Building TF for [{}] field of the Index'.format(field_name))
@@ -26,46 +41,96 @@ def get_database_tfs(ix_reader: MultiReader, field_name='body'):
 class IndexVirtualPartition(object):
 
     def __init__(self, file_index: index.FileIndex, index_docnums: list=None, name: str='DB',
-                 ix_reader: IndexReader=None, content_field='body'):
+                 ix_reader: IndexReader=None, content_field='body', vocabulary: TermVocabulary=None,
+                 forward_index: ForwardIndex=None, result_cache: ResultCache=SHARED_CACHE,
+                 term_counts: tuple=None):
         self.name = name
         self.ix = file_index
         self._reader = ix_reader if ix_reader is not None else file_index.reader()
         self._private_reader = False if ix_reader is not None else True
         self._searcher = Searcher(self._reader)
-        if index_docnums is not None:
-            self._docnums = set(index_docnums)
+        # members are kept as a bitmap over the docnum space of the index
+        if isinstance(index_docnums, DocnumBitmap):
+            self._docnums = index_docnums.copy()
+        elif index_docnums is not None:
+            self._docnums = DocnumBitmap(self._reader.doc_count_all(), index_docnums)
         else:
             self._docnums = self._get_all_db_ids()
-        self._dfs, self._tfs, self._total_terms = self._build(content_field)
-        self._tfidfs = defaultdict(float)
+        # term vectors are read from the forward index snapshot when there is one
+        self._forward = forward_index if forward_index is not None else ForwardIndex.open(file_index, content_field)
+        # term statistics are count vectors aligned with the term ids of the vocabulary
+        if vocabulary is None:
+            vocabulary = self._forward.vocabulary if self._forward is not None \
+                else TermVocabulary.from_reader(self._reader, content_field)
+        self._vocabulary = vocabulary
+        self._content_field = content_field
+        # term_counts: (dfs, tfs, total terms) of the docnums when they are already counted (e.g. by the Partitioner)
+        self._dfs, self._tfs, self._total_terms = term_counts if term_counts is not None \
+            else self._build(content_field)
+        # log of the effective df of every term, computed on demand; nan marks a term that is not computed yet
+        # or that was changed by add_doc/remove_doc since
+        self._log_effective_dfs = None
+        self._trackers = []
+        # search results are cached under (partition id, generation, ...); the generation changes with the docs
+        self._result_cache = result_cache
+        self._id = next(_partition_ids)
+        self._generation = 0
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self._private_reader:
             self._reader.close()
 
     def _get_all_db_ids(self):
-        all_ids = set()
-        for i in self._reader.all_doc_ids():
-            all_ids.add(i)
-        return all_ids
+        if not self._reader.has_deletions():
+            return DocnumBitmap.full(self._reader.doc_count_all())
+        return DocnumBitmap(self._reader.doc_count_all(), self._reader.all_doc_ids())
 
     def doc_count(self):
         return len(self._docnums)
 
+    def _doc_vector(self, docnum, fieldname='body'):
+        """(term ids, frequencies) of the forward index (vector) of a document; (None, None) if it has no vector"""
+        if self._forward is not None and self._forward.fieldname == fieldname:
+            ids, freqs = self._forward.vector(docnum)
+            return (ids, freqs.astype(np.int64)) if len(ids) > 0 else (None, None)
+        if not self._reader.has_vector(docnum, fieldname):
+            return None, None
+        vector = list(self._reader.vector_as('frequency', docnum, fieldname))
+        ids = self._vocabulary.ids(t for t, _ in vector)
+        freqs = np.fromiter((f for _, f in vector), dtype=np.int64, count=len(vector))
+        return ids, freqs
+
+    def _doc_rows(self, docnums, fieldname='body'):
+        """CSR arrays (indptr, term ids, frequencies) of the vectors of the documents, in the given order"""
+        if self._forward is not None and self._forward.fieldname == fieldname:
+            return self._forward.rows(docnums)
+        vectors = [self._doc_vector(dn, fieldname) for dn in docnums]
+        indptr = np.zeros(len(vectors) + 1, dtype=np.int64)
+        np.cumsum([len(ids) if ids is not None else 0 for ids, _ in vectors], out=indptr[1:])
+        empty = np.zeros(0, dtype=np.int64)
+        return indptr, \
+            np.concatenate([empty] + [ids for ids, _ in vectors if ids is not None]), \
+            np.concatenate([empty] + [freqs for ids, freqs in vectors if ids is not None])
+
     def _build(self, fieldname='body'):
-        tfs, dfs = defaultdict(int), defaultdict(int)
-        total_terms = 0
-        for dn in list(self._docnums):
-            if self._reader.has_vector(dn, fieldname):
-                tfs_list = self._reader.vector_as('frequency', dn, fieldname)
-                for tf in tfs_list:
-                    tfs[tf[0]] += tf[1]
-                    total_terms += tf[1]
-                    dfs[tf[0]] += 1
+        if self._forward is not None and self._forward.fieldname == fieldname:
+            docnums = self._docnums.to_array()
+            for dn in docnums[self._forward.doc_lengths(docnums) == 0]:
+                LOGGER.warning('No forward index (vector) on {} for {}'
+                                .format(fieldname, self._reader.stored_fields(dn)))
+            return self._forward.term_counts(docnums)
+        tfs = np.zeros(len(self._vocabulary), dtype=np.int64)
+        dfs = np.zeros(len(self._vocabulary), dtype=np.int64)
+        for dn in self._docnums:
+            ids, freqs = self._doc_vector(dn, fieldname)
+            if ids is not None:
+                # term ids are unique within a vector, so fancy-indexed increments do not collide
+                tfs[ids] += freqs
+                dfs[ids] += 1
             else:
                 LOGGER.warning('No forward index (vector) on {} for {}'
                                 .format(fieldname, self._reader.stored_fields(dn)))
-        return dfs, tfs, total_terms
+        return dfs, tfs, int(tfs.sum())
 
     def all_terms_count(self):
         return self._total_terms
@@ -73,74 +138,187 @@ class IndexVirtualPartition(object):
     def add_doc(self, docnum, fieldname='body'):
         if docnum not in self._docnums:
             self._docnums.add(docnum)
-            ireader = self._reader
-            if ireader.has_vector(docnum, fieldname):
-                tfs_list = ireader.vector_as('frequency', docnum, fieldname)
-                for tf in tfs_list:
-                    self._tfs[tf[0]] += tf[1]
-                    self._total_terms += tf[1]
-                    self._dfs[tf[0]] += 1
+            self._membership_changed()
+            ids, freqs = self._doc_vector(docnum, fieldname)
+            if ids is not None:
+                self._tfs[ids] += freqs
+                self._dfs[ids] += 1
+                self._total_terms += int(freqs.sum())
+                self._terms_changed(ids)
             else:
                 LOGGER.warning('No forward index (vector) on {} for {}'
                                 .format(fieldname, self._reader.stored_fields(docnum)))
 
     def remove_doc(self, docnum, fieldname='body'):
         if docnum in self._docnums:
-            self._docnums.remove(docnum)
-            ireader = self._reader
-            if ireader.has_vector(docnum, fieldname):
-                tfs_list = ireader.vector_as('frequency', docnum, fieldname)
-                for tf in tfs_list:
-                    self._tfs[tf[0]] -= tf[1]
-                    self._total_terms -= tf[1]
-                    self._dfs[tf[0]] -= 1
-                    if self._tfs[tf[0]] <= 0:
-                        if self._tfs[tf[0]] == 0:
-                            self._tfs.pop(tf[0])
-                            self._dfs.pop(tf[0])
-                        else:
-                            raise ValueError('Negative value for tf in partition {}'.format(self.name))
+            self._docnums.discard(docnum)
+            self._membership_changed()
+            ids, freqs = self._doc_vector(docnum, fieldname)
+            if ids is not None:
+                self._tfs[ids] -= freqs
+                self._dfs[ids] -= 1
+                self._total_terms -= int(freqs.sum())
+                if (self._tfs[ids] < 0).any():
+                    raise ValueError('Negative value for tf in partition {}'.format(self.name))
+                self._terms_changed(ids)
             else:
                 LOGGER.warning('No forward index (vector) on {} for {}'
                                 .format(fieldname, self._reader.stored_fields(docnum)))
 
-    def search(self, text: str, sorted_by_count=False, fieldname='body'):
-        """returns (dset, item_gen)
-        results.docs(): a set of docnum of the results in index
-        results.items(): a generator for (docnum, score) in from highest score/count to lowest
+    def add_docs(self, docnums: list, fieldname='body'):
+        """add_doc for a batch of documents; the term counts are updated once for the whole batch"""
+        docnums = np.unique(np.asarray(docnums, dtype=np.int64))
+        docnums = docnums[~self._docnums.contains(docnums)]
+        self._docnums.update(docnums)
+        self._update_counts(docnums, 1, fieldname)
+
+    def remove_docs(self, docnums: list, fieldname='body'):
+        """remove_doc for a batch of documents; the term counts are updated once for the whole batch"""
+        docnums = np.unique(np.asarray(docnums, dtype=np.int64))
+        docnums = docnums[self._docnums.contains(docnums)]
+        self._docnums.difference_update(docnums)
+        self._update_counts(docnums, -1, fieldname)
+
+    def _update_counts(self, docnums: list, sign: int, fieldname='body'):
+        if len(docnums) == 0:
+            return
+        self._membership_changed()
+        indptr, term_ids, freqs = self._doc_rows(docnums, fieldname)
+        for dn in np.asarray(docnums)[np.diff(indptr) == 0]:
+            LOGGER.warning('No forward index (vector) on {} for {}'
+                            .format(fieldname, self._reader.stored_fields(dn)))
+        # only the terms of the documents are touched
+        ids, inverse = np.unique(term_ids, return_inverse=True)
+        self._tfs[ids] += sign * np.bincount(inverse, weights=freqs, minlength=len(ids)).astype(np.int64)
+        self._dfs[ids] += sign * np.bincount(inverse, minlength=len(ids))
+        self._total_terms += sign * int(freqs.sum())
+        if (self._tfs[ids] < 0).any():
+            raise ValueError('Negative value for tf in partition {}'.format(self.name))
+        self._terms_changed(ids)
+
+    def _membership_changed(self):
+        self._generation += 1
+        if self._result_cache is not None:
+            self._result_cache.invalidate(self._id)
+
+    def _terms_changed(self, term_ids):
+        if self._log_effective_dfs is not None:
+            self._log_effective_dfs[term_ids] = np.nan
+        for tracker in self._trackers:
+            tracker.update(term_ids)
+
+    def track_divergence(self, other, similarity_measure_type: str='kld', tolerance: float=1e-3):
+        """A DivergenceTracker of the tf divergence of this partition from other, kept up to date
+        as documents are added to or removed from either partition"""
+        tracker = DivergenceTracker(self, other, similarity_measure_type, tolerance)
+        self._trackers.append(tracker)
+        if other is not self:
+            other._trackers.append(tracker)
+        return tracker
+
+    def untrack(self, tracker):
+        """Stops updating a tracker of track_divergence, on both of its partitions"""
+        for part in (tracker._part1, tracker._part2):
+            if tracker in part._trackers:
+                part._trackers.remove(tracker)
+
+    def docs_with_terms(self, docnums: list, term_mask: np.ndarray, fieldname='body',
+                        batch_size: int=config.DIVERGENCE_batch_size) -> list:
+        """the documents (of docnums) that contain at least one of the terms selected by the term-id mask"""
+        found = []
+        for bst in range(0, len(docnums), batch_size):
+            batch = docnums[bst:bst + batch_size]
+            indptr, term_ids, _ = self._doc_rows(batch, fieldname)
+            rows = np.repeat(np.arange(len(batch)), np.diff(indptr))
+            hits = np.bincount(rows[term_mask[term_ids]], minlength=len(batch))
+            found += [dn for dn, h in zip(batch, hits.tolist()) if h > 0]
+        return found
+
+    def search(self, text: str, sorted_by_count=False, fieldname='body', limit: int=None):
+        """returns (dset, item_gen) of the documents of the partition that match the query
+        dset: a set of docnum of the results in index (only the top limit ones when limit is given)
+        item_gen: a generator for (docnum, score) in from highest score/count to lowest
         """
         isearcher = self._searcher
-        skw = {'limit': None}
+        skw = {'limit': limit}
         skw['q'] = QueryParser("body", self.ix.schema).parse(text)
+        if len(self._docnums) == 0:
+            # whoosh reads an empty filter as no filter at all
+            return set(), iter([])
+        if len(self._docnums) < self._reader.doc_count():
+            # member documents only are scored and sorted
+            skw['filter'] = self._docnums
+        cache_key = None
+        if self._result_cache is not None:
+            cache_key = (self._id, self._generation, skw['q'].normalize(),
+                         'count' if sorted_by_count else 'score', limit)
+            cached = self._result_cache.get(cache_key)
+            if cached is not None:
+                return set(cached[0]), iter(cached[1])
         if sorted_by_count:
             skw['sortedby'] = sorting.FieldFacet('count', reverse=True)
         results = isearcher.search(**skw)
-        return results.docs(), results.items()
+        if cache_key is None and limit is None:
+            return results.docs(), results.items()
+        items = list(results.items())
+        docs = results.docs() if limit is None else set(dn for dn, _ in items)
+        if cache_key is not None:
+            self._result_cache.put(cache_key, docs, items)
+        return set(docs), iter(items)
+
+    def get_result_cache(self) -> ResultCache:
+        return self._result_cache
 
     def get_tfs(self):
-        # return self._tfs.copy()
-        return self._tfs
+        return TermCountView(self._vocabulary, self._tfs)
 
     def get_dfs(self):
-        # return self._dfs.copy()
-        return self._dfs
+        return TermCountView(self._vocabulary, self._dfs)
+
+    def get_vocabulary(self):
+        return self._vocabulary
+
+    def get_forward_index(self):
+        return self._forward
 
     def get_tfidfs(self):
-        if len(self._tfidfs) == 0:
-            raise ValueError('Empty tfidf. It must be updated before use.')
-        return self._tfidfs
+        """tf-idf of the terms, computed (and cached) only for the terms that are read"""
+        return TermScoreView(self._vocabulary, self._tfs, self._tfidf_of)
+
+    def _tfidf_of(self, term_ids: np.ndarray) -> np.ndarray:
+        if self._log_effective_dfs is None:
+            self._log_effective_dfs = np.full(len(self._vocabulary), np.nan)
+        log_effective_dfs = self._log_effective_dfs[term_ids]
+        missing = np.isnan(log_effective_dfs)
+        if missing.any():
+            ids = term_ids[missing]
+            global_dfs = self._vocabulary.doc_frequencies(self._reader, self._content_field)
+            log_effective_dfs[missing] = np.log(1 + global_dfs[ids] - self._dfs[ids])
+            self._log_effective_dfs[ids] = log_effective_dfs[missing]
+        effective_doc_count = 1 + self._reader.doc_count() - self.doc_count()
+        return self._tfs[term_ids] * (log(effective_doc_count) - log_effective_dfs)
 
     def get_total_terms(self):
         return self._total_terms
 
+    def term_probabilities(self) -> np.ndarray:
+        """tf / total terms of every term of the vocabulary"""
+        return self._tfs / max(self._total_terms, 1)
+
     def update_tfidfs(self, fieldname='body'):
-        effective_doc_count = 1 + self._reader.doc_count() - self.doc_count()
-        for t in self._tfs:
-            effective_df = 1 + self._reader.doc_frequency(fieldname, t) - self._dfs[t]
-            self._tfidfs[t] = self._tfs[t] * log(effective_doc_count / effective_df)
+        """computes the tf-idf of all the terms of the partition ahead of use"""
+        self._tfidf_of(np.flatnonzero(self._tfs))
 
     def get_docnums(self):
-        return list(self._docnums)
+        return self._docnums.to_array().tolist()
+
+    def iter_docnums(self):
+        """docnums of the partition in increasing order, without copying them"""
+        return iter(self._docnums)
+
+    def get_docnum_set(self) -> DocnumBitmap:
+        """the membership bitmap of the partition; it is shared, so it must not be modified"""
+        return self._docnums
 
     def all_stored_fields(self):
         """ A generator for stored fields
@@ -148,32 +326,94 @@ class IndexVirtualPartition(object):
         {'articleID': '1', 'count': 10, 'title': 'Hi', 'xpath': '/Volumes/archive/Code/PycharmProjects/database-capacity/database-capacity/python/cache_enhancement/data/sample/sample_docs/1.txt'}
         """
         ireader = self._reader
-        for dn in list(self._docnums):
-            yield ireader.stored_fields(dn)
+        for dn in self._docnums.to_array():
+            yield ireader.stored_fields(int(dn))
 
     def _all_stored_fields(self):
         sf = {}
         ireader = self._reader
-        for dn in list(self._docnums):
+        for dn in self._docnums:
             sf[dn] = ireader.stored_fields(dn)
         return sf
 
+    def save_state(self, file_path: str):
+        """Saves the membership bitmap and the term counts to an .npz file (written to a temporary file first),
+        so that load_state can restore the partition without reading the index"""
+        tmp_path = file_path + '.tmp.npz'
+        np.savez(tmp_path, name=np.array(self.name), size=np.array(self._docnums.size),
+                 words=self._docnums.words(), dfs=self._dfs, tfs=self._tfs, total_terms=np.array(self._total_terms),
+                 content_field=np.array(self._content_field), index_generation=np.array(self.ix.latest_generation()))
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load_state(cls, file_index: index.FileIndex, file_path: str, ix_reader: IndexReader=None,
+                   vocabulary: TermVocabulary=None, forward_index: ForwardIndex=None,
+                   result_cache: ResultCache=SHARED_CACHE):
+        """The partition saved by save_state; the index must be at the generation it was saved with"""
+        with np.load(file_path) as state:
+            if int(state['index_generation']) != file_index.latest_generation():
+                raise ValueError('Partition state {} was saved at index generation {}, the index is at {}'
+                                 .format(file_path, int(state['index_generation']), file_index.latest_generation()))
+            content_field = str(state['content_field'])
+            docnums = DocnumBitmap.from_words(int(state['size']), state['words'])
+            term_counts = (state['dfs'], state['tfs'], int(state['total_terms']))
+            name = str(state['name'])
+        if forward_index is None:
+            forward_index = ForwardIndex.open(file_index, content_field)
+        if vocabulary is None and forward_index is not None:
+            vocabulary = forward_index.vocabulary
+        partition = cls(file_index, docnums, name, ix_reader, content_field, vocabulary, forward_index,
+                        result_cache, term_counts)
+        if len(partition.get_vocabulary()) != len(term_counts[1]):
+            raise ValueError('Partition state {} does not match the vocabulary of the index'.format(file_path))
+        return partition
+
     def docs_divergence(self, docnums: list,
                         similarity_measure_type: str='avg-kld',
                         score_type: str='tf',
-                        fieldname: str='body'):
+                        fieldname: str='body',
+                        batch_size: int=None,
+                        procs: int=1):
+        """Divergence of every document from this partition.
+        With a batch_size, the documents are scored batch_size at a time as rows of a sparse (doc x term) matrix.
+        With procs > 1, the batches are split across a pool of processes (it requires the forward index).
+        """
         div = {}
         st = time.time()
         LOGGER.info('Calculating {} of {} documents from {} based on {}'.format(similarity_measure_type,
                                                                                 len(docnums),
                                                                                 self.name,
                                                                                 score_type))
+        if procs > 1 and (self._forward is None or self._forward.fieldname != fieldname):
+            LOGGER.warning('No forward index on {} for {}; running on a single process'.format(fieldname, self.name))
+            procs = 1
+        if procs > 1 or batch_size is not None:
+            batch_size = batch_size if batch_size is not None else config.DIVERGENCE_batch_size
+            if procs > 1:
+                all_div, all_lengths = self._parallel_docs_divergence(docnums, similarity_measure_type, score_type,
+                                                                      fieldname, batch_size, procs)
+                batches = [(docnums, all_div, all_lengths)]
+            else:
+                batches = ((docnums[bst:bst + batch_size],) +
+                           self._batch_docs_divergence(docnums[bst:bst + batch_size], similarity_measure_type,
+                                                       score_type, fieldname)
+                           for bst in range(0, len(docnums), batch_size))
+            for batch, batch_div, lengths in batches:
+                for dn, d, l in zip(batch, batch_div.tolist(), lengths.tolist()):
+                    if l > 0:
+                        div[dn] = d
+                    else:
+                        LOGGER.warning('Manually assigned {}=0.0 for {}'.format(similarity_measure_type, dn))
+                        div[dn] = 0
+            LOGGER.info('{} {} calculation rate: {} d/s'.format(score_type, similarity_measure_type,
+                                                                  len(docnums)/(time.time()-st)))
+            return div
         term_scoring, doc_tot_terms = None, 0
         for dn in docnums:
             if score_type == 'tf':
-                term_scoring, doc_tot_terms = get_doc_tf(self._reader, dn, fieldname)
+                term_scoring, doc_tot_terms = get_doc_tf(self._reader, dn, fieldname, self._forward)
             elif score_type == 'tfidf':
-                term_scoring, doc_tot_terms = get_doc_tfidf(self._reader, dn, fieldname)
+                term_scoring, doc_tot_terms = get_doc_tfidf(self._reader, dn, fieldname, self._forward)
             if term_scoring is not None:
                 if similarity_measure_type == 'avg-kld':
                     div[dn] = mt.avg_kl_divergence(term_scoring, self.get_tfs(), doc_tot_terms, self.get_total_terms())
@@ -186,8 +426,88 @@ class IndexVirtualPartition(object):
                                                               len(docnums)/(time.time()-st)))
         return div
 
+    def _batch_docs_divergence(self, docnums: list, similarity_measure_type: str, score_type: str, fieldname: str):
+        """(divergences, number of distinct terms) of the documents, aligned with docnums"""
+        global_dfs = self._vocabulary.doc_frequencies(self._reader, fieldname) if score_type == 'tfidf' else None
+        return _rows_divergence(self._doc_rows(docnums, fieldname), self._tfs, self._total_terms,
+                                similarity_measure_type, score_type, global_dfs, self._reader.doc_count())
+
+    def _parallel_docs_divergence(self, docnums: list, similarity_measure_type: str, score_type: str,
+                                  fieldname: str, batch_size: int, procs: int):
+        """Splits the documents into batches scored by a pool of procs workers. Workers read the document vectors
+        from the forward index and the partition's term counts from a memory-mapped copy, so nothing large is
+        pickled. Batches are returned in order, so the result does not depend on the number of workers."""
+        shared_dir = tempfile.mkdtemp(prefix='docs_divergence_')
+        try:
+            tfs_path = os.path.join(shared_dir, 'tfs.npy')
+            np.save(tfs_path, self._tfs)
+            dfs_path = None
+            if score_type == 'tfidf':
+                dfs_path = os.path.join(shared_dir, 'dfs.npy')
+                np.save(dfs_path, self._vocabulary.doc_frequencies(self._reader, fieldname))
+            tasks = [(self._forward.path, tfs_path, dfs_path, self._total_terms, self._reader.doc_count(),
+                      docnums[bst:bst + batch_size], similarity_measure_type, score_type)
+                     for bst in range(0, len(docnums), batch_size)]
+            with multiprocessing.Pool(procs) as pool:
+                results = pool.map(_docs_divergence_worker, tasks, chunksize=1)
+        finally:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+        if len(results) == 0:
+            return np.zeros(0), np.zeros(0, dtype=np.int64)
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+
+def _rows_divergence(rows: tuple, tfs: np.ndarray, total_terms: int, similarity_measure_type: str,
+                     score_type: str, global_dfs: np.ndarray=None, doc_count: int=0):
+    """(divergences, number of distinct terms) of the documents in CSR rows (indptr, term ids, freqs)
+    from a partition with the term counts tfs"""
+    indptr, term_ids, freqs = rows
+    freqs = freqs.astype(np.float64)
+    lengths = np.diff(indptr)
+    n = len(lengths)
+    doc_tot_terms = np.bincount(np.repeat(np.arange(n), lengths), weights=freqs, minlength=n)
+    measure = freqs
+    if score_type == 'tfidf':
+        measure = freqs * np.log(doc_count / global_dfs[term_ids])
+    rows_measure = sparse.csr_matrix((measure, term_ids, indptr), shape=(n, len(tfs)))
+    batch_div = np.zeros(n)
+    if similarity_measure_type == 'avg-kld':
+        batch_div = mt.avg_kl_divergence_rows(rows_measure, tfs, doc_tot_terms, total_terms)
+        # the comparison is over the smaller vocabulary; it is rarely the partition's
+        partition_ids = np.flatnonzero(tfs)
+        for r in np.flatnonzero(lengths > len(partition_ids)):
+            row_measure = np.zeros(len(tfs))
+            row_measure[term_ids[indptr[r]:indptr[r + 1]]] = measure[indptr[r]:indptr[r + 1]]
+            batch_div[r] = mt.avg_kl_divergence_array(row_measure[partition_ids], tfs[partition_ids],
+                                                      doc_tot_terms[r], total_terms)
+    elif similarity_measure_type == 'kld':
+        batch_div = mt.kl_divergence_rows(rows_measure, tfs, doc_tot_terms, total_terms)
+    return batch_div, lengths
+
+
+def _docs_divergence_worker(task):
+    forward_path, tfs_path, dfs_path, total_terms, doc_count, docnums, similarity_measure_type, score_type = task
+    tfs = np.load(tfs_path, mmap_mode='r')
+    global_dfs = np.load(dfs_path, mmap_mode='r') if dfs_path is not None else None
+    return _rows_divergence(ForwardIndex(forward_path).rows(docnums), tfs, total_terms,
+                            similarity_measure_type, score_type, global_dfs, doc_count)
 
-def get_doc_tf(ireader, dn, fieldname):
+
+def _forward_doc_vector(forward_index: ForwardIndex, dn):
+    """(terms, frequencies) of a document from the forward index snapshot; None if it has no vector there"""
+    ids, freqs = forward_index.vector(dn)
+    if len(ids) == 0:
+        return None
+    terms = forward_index.vocabulary.terms()
+    return [terms[i] for i in ids], freqs.tolist()
+
+
+def get_doc_tf(ireader, dn, fieldname, forward_index: ForwardIndex=None):
+    if forward_index is not None and forward_index.fieldname == fieldname:
+        vector = _forward_doc_vector(forward_index, dn)
+        if vector is None:
+            return None, 0
+        return defaultdict(int, zip(*vector)), sum(vector[1])
     if ireader.has_vector(dn, fieldname):
         doc_tfs = defaultdict(int)
         doc_tot_terms = 0
@@ -199,12 +519,19 @@ def get_doc_tf(ireader, dn, fieldname):
         return None, 0
 
 
-def get_doc_tfidf(ireader, dn, fieldname):
-    if ireader.has_vector(dn, fieldname):
+def get_doc_tfidf(ireader, dn, fieldname, forward_index: ForwardIndex=None):
+    if forward_index is not None and forward_index.fieldname == fieldname:
+        vector = _forward_doc_vector(forward_index, dn)
+        vector = zip(*vector) if vector is not None else None
+    elif ireader.has_vector(dn, fieldname):
+        vector = ireader.vector_as('frequency', dn, fieldname)
+    else:
+        vector = None
+    if vector is not None:
         doc_tfidfs = defaultdict(int)
         tot_docs = ireader.doc_count()
         doc_tot_terms = 0
-        for t, f in ireader.vector_as('frequency', dn, fieldname):
+        for t, f in vector:
             doc_tfidfs[t] = f * log(tot_docs / ireader.doc_frequency(fieldname, t))
             doc_tot_terms += f
         return doc_tfidfs, doc_tot_terms
@@ -224,7 +551,17 @@ def divergence(part1: IndexVirtualPartition, part2: IndexVirtualPartition,
     elif score_type == 'tfidf':
         measure1 = part1.get_tfidfs()
         measure2 = part2.get_tfidfs()
-    if similarity_measure_type == 'avg-kld':
+    if part1.get_vocabulary() is part2.get_vocabulary():
+        # both measures are aligned by term id; compare them directly over the terms of the chosen side
+        if similarity_measure_type == 'avg-kld':
+            ids = measure1.ids() if len(measure1) <= len(measure2) else measure2.ids()
+            div = mt.avg_kl_divergence_array(measure1.measure(ids), measure2.measure(ids),
+                                             part1.get_total_terms(), part2.get_total_terms())
+        elif similarity_measure_type == 'kld':
+            ids = measure1.ids()
+            div = mt.kl_divergence_array(measure1.measure(ids), measure2.measure(ids),
+                                         part1.get_total_terms(), part2.get_total_terms())
+    elif similarity_measure_type == 'avg-kld':
         div = mt.avg_kl_divergence(measure1, measure2, part1.get_total_terms(), part2.get_total_terms())
     elif similarity_measure_type == 'kld':
         div = mt.kl_divergence(measure1, measure2, part1.get_total_terms(), part2.get_total_terms())
@@ -233,10 +570,91 @@ def divergence(part1: IndexVirtualPartition, part2: IndexVirtualPartition,
     return div
 
 
+class DivergenceTracker(object):
+    """divergence(part1, part2) on tf, maintained from per-term contributions while documents move in or out
+    of either partition. An update only touches the terms of the changed documents.
+    KLD is kept exact:
+        KLD = S/N1 + A/N1 * log((N1+N2)/N1),  S = sum(a log(a/b)), A = sum(a),  a = tf1+0.01, b = tf1+tf2+0.02
+    over the terms of part1. The avg-KLD terms depend on the partition sizes too, so they are all recomputed
+    only when a size drifts more than tolerance (relative) from the last full computation."""
+
+    def __init__(self, part1: IndexVirtualPartition, part2: IndexVirtualPartition,
+                 similarity_measure_type: str='kld', tolerance: float=1e-3):
+        if part1.get_vocabulary() is not part2.get_vocabulary():
+            raise ValueError('Partitions {} and {} do not share a vocabulary'.format(part1.name, part2.name))
+        if similarity_measure_type not in ('kld', 'avg-kld'):
+            raise ValueError('Unknown similarity measure {}'.format(similarity_measure_type))
+        self._part1 = part1
+        self._part2 = part2
+        self.similarity_measure_type = similarity_measure_type
+        self.tolerance = tolerance
+        self.refresh()
+
+    def _kld_terms(self, ids):
+        tf1 = self._part1._tfs[ids].astype(np.float64)
+        a = tf1 + 0.01
+        b = a + self._part2._tfs[ids] + 0.01
+        in1 = tf1 > 0
+        return np.where(in1, a * np.log(a / b), 0.0), np.where(in1, a, 0.0)
+
+    def _avg_kld_terms(self, ids):
+        tf1, tf2 = self._part1._tfs[ids], self._part2._tfs[ids]
+        vocabularies = tf1 if self._first_is_smaller else tf2
+        n1, n2 = self._part1.get_total_terms(), self._part2.get_total_terms()
+        return np.where(vocabularies > 0, mt.avg_kl_divergence_terms(tf1, tf2, n1, n2), 0.0)
+
+    def refresh(self):
+        """recomputes every term contribution from the current counts"""
+        ids = np.arange(len(self._part1.get_vocabulary()))
+        if self.similarity_measure_type == 'kld':
+            self._contributions, self._a = self._kld_terms(ids)
+            self._sum_a = float(self._a.sum())
+        else:
+            self._nonzero = [np.count_nonzero(self._part1._tfs), np.count_nonzero(self._part2._tfs)]
+            self._first_is_smaller = self._nonzero[0] <= self._nonzero[1]
+            self._reference_totals = (self._part1.get_total_terms(), self._part2.get_total_terms())
+            self._present = [self._part1._tfs > 0, self._part2._tfs > 0]
+            self._contributions = self._avg_kld_terms(ids) \
+                if min(self._reference_totals) > 0 else np.zeros(len(ids))
+        self._sum = float(self._contributions.sum())
+
+    def update(self, term_ids):
+        """called by the partitions after the counts of the terms have changed"""
+        ids = np.unique(term_ids)
+        old = self._contributions[ids]
+        if self.similarity_measure_type == 'kld':
+            new, a = self._kld_terms(ids)
+            self._sum_a += float(a.sum() - self._a[ids].sum())
+            self._a[ids] = a
+        else:
+            for i, part in enumerate((self._part1, self._part2)):
+                present = part._tfs[ids] > 0
+                self._nonzero[i] += int(present.sum() - self._present[i][ids].sum())
+                self._present[i][ids] = present
+            totals = (self._part1.get_total_terms(), self._part2.get_total_terms())
+            if min(totals) == 0 or min(self._reference_totals) == 0 or \
+                    (self._nonzero[0] <= self._nonzero[1]) != self._first_is_smaller or \
+                    any(abs(n / r - 1) > self.tolerance for n, r in zip(totals, self._reference_totals)):
+                self.refresh()
+                return
+            new = self._avg_kld_terms(ids)
+        self._sum += float(new.sum() - old.sum())
+        self._contributions[ids] = new
+
+    def value(self) -> float:
+        n1, n2 = self._part1.get_total_terms(), self._part2.get_total_terms()
+        if n1 == 0 or n2 == 0:
+            LOGGER.warning('Divergence 0.0000 for no-term partition!')
+            return 0.0
+        if self.similarity_measure_type == 'kld':
+            return self._sum / n1 + self._sum_a / n1 * log((n1 + n2) / n1)
+        return self._sum
+
+
 def combine(part1: IndexVirtualPartition, part2: IndexVirtualPartition):
-    com_part = IndexVirtualPartition(part1.ix, part1.get_docnums())
-    for dn in part2.get_docnums():
-        com_part.add_doc(dn)
+    com_part = IndexVirtualPartition(part1.ix, part1.get_docnum_set(), vocabulary=part1.get_vocabulary(),
+                                     forward_index=part1.get_forward_index())
+    com_part.add_docs(part2.get_docnum_set().difference(part1.get_docnum_set()).to_array())
     return com_part
 
 
@@ -245,26 +663,47 @@ class Partitioner(object):
     def __init__(self, ix: index.FileIndex, ix_reader: IndexReader):
         self._ix = ix
         self._reader = ix_reader
-        self._pop_dn = []
-        for dx in ix_reader.iter_docs():
-            self._pop_dn += [(int(dx[1]['count']), dx[0])]
-        self._pop_dn.sort(reverse=True)
-
-    def generate(self, threasholds=[0.9]):
-        threasholds += [1.0]
-        threasholds = list(set(threasholds))
-        threasholds.sort(reverse=True)
-        c = 0
-        ti = 1
-        docnums = []
-        for pdn in self._pop_dn:
-            c += 1
-            docnums += [pdn[1]]
-            if c >= (1.0 - threasholds[ti]) * len(self._pop_dn):
-                yield IndexVirtualPartition(self._ix, docnums,
-                                            '{}-{}_part'.format(threasholds[ti], threasholds[ti-1]),
-                                            self._reader)
-                docnums = []
-                ti += 1
-                if ti == len(threasholds):
-                    break
+        self._forward = ForwardIndex.open(ix)
+        self._vocabulary = self._forward.vocabulary if self._forward is not None \
+            else TermVocabulary.from_reader(ix_reader)
+        counts = numeric_column(ix_reader, 'count')
+        docnums = np.arange(len(counts), dtype=np.int64)
+        if ix_reader.has_deletions():
+            docnums = np.fromiter(ix_reader.all_doc_ids(), dtype=np.int64)
+            counts = counts[docnums]
+        # (count, docnum) as a single key; the most popular documents (ties by the highest docnum) come first
+        self._pop_keys = counts * (ix_reader.doc_count_all() + 1) + docnums
+        self._pop_docnums = docnums
+
+    def generate(self, threasholds=[0.9], shared_scan=False, procs=1):
+        """Yields the partitions of the documents by popularity, the most popular first.
+        With shared_scan, the term counts of all the partitions are gathered in one pass over the forward index
+        (split across procs workers) before the first one is yielded, instead of one pass per partition."""
+        threasholds = sorted(set(threasholds + [1.0]), reverse=True)
+        doc_count = len(self._pop_docnums)
+        # every partition ends at the first document at or past its share of the documents
+        ends = []
+        for th in threasholds[1:]:
+            end = max(int(ceil((1.0 - th) * doc_count)), (ends[-1] if ends else 0) + 1)
+            if end > doc_count:
+                break
+            ends.append(end)
+        if len(ends) == 0:
+            return
+        # only the cut points are put in place; the order inside a partition does not matter
+        cuts = [end for end in ends if end < doc_count]
+        order = np.argpartition(-self._pop_keys, cuts) if len(cuts) > 0 else np.arange(doc_count)
+        starts = [0] + ends[:-1]
+        term_counts = [None] * len(ends)
+        if shared_scan and self._forward is not None:
+            labels = np.full(self._forward.doc_count_all(), -1, dtype=np.int8 if len(ends) < 128 else np.int32)
+            for pi, (start, end) in enumerate(zip(starts, ends)):
+                labels[self._pop_docnums[order[start:end]]] = pi
+            term_counts = self._forward.partition_term_counts(labels, len(ends), procs)
+        elif shared_scan:
+            LOGGER.warning('No forward index for a shared scan; the partitions are counted one by one')
+        for ti, (start, end) in enumerate(zip(starts, ends), 1):
+            yield IndexVirtualPartition(self._ix, self._pop_docnums[order[start:end]],
+                                        '{}-{}_part'.format(threasholds[ti], threasholds[ti-1]),
+                                        self._reader, vocabulary=self._vocabulary,
+                                        forward_index=self._forward, term_counts=term_counts[ti-1])
@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 import sys
 from collections import defaultdict
 
@@ -6,22 +7,25 @@ from whoosh.qparser import QueryParser
 
 import config
 import metrics
-from partition import IndexVirtualPartition, Partitioner
+from forward import ForwardIndex
+from fieldcache import ArticleDocnumIndex
+from partition import IndexVirtualPartition, Partitioner, get_doc_tf
 import whoosh.index as index
 import whoosh.analysis as analysis
 from math import log
 from whoosh.reading import MultiReader
 from whoosh.searching import Searcher
 import logging
-from functools import reduce
 
 LOGGER = logging.getLogger()
 
+# the analyzer of the indexed fields (see build.schema), built once and shared by all queries
+ANALYZER = analysis.StandardAnalyzer()
+
 
 def tokenize(query: str) -> defaultdict:
-    analyzer = analysis.StandardAnalyzer()
     tokens = defaultdict(int)
-    for token in analyzer(query):
+    for token in ANALYZER(query):
         tokens[token.text] += 1
     return tokens
 
@@ -37,14 +41,22 @@ def get_index_docnum_of_article_id(article_id: str, ix_reader: MultiReader, arti
     return rslts[0].docnum
 
 
-def get_docs_tfs(article_ids: list, ix_reader: MultiReader, fieldname='body') -> defaultdict(lambda: defaultdict(int)):
+def get_docs_tfs(article_ids: list, ix_reader: MultiReader, fieldname='body',
+                 forward_index: ForwardIndex=None,
+                 article_docnums: ArticleDocnumIndex=None) -> defaultdict(lambda: defaultdict(int)):
     docs_tfs = defaultdict(lambda: defaultdict(int))
-    for aId in article_ids:
-        dn = get_index_docnum_of_article_id(aId, ix_reader)
+    if article_docnums is not None:
+        docnums = article_docnums.docnums(article_ids).tolist()
+        for aId, dn in zip(article_ids, docnums):
+            if dn == -1:
+                LOGGER.warning('Article ID {} was not found in the index'.format(aId))
+    else:
+        docnums = [get_index_docnum_of_article_id(aId, ix_reader) for aId in article_ids]
+    for aId, dn in zip(article_ids, docnums):
         if dn == -1:
             continue
-        if ix_reader.has_vector(dn, fieldname):
-            tf_d = defaultdict(int, ix_reader.vector_as('frequency', dn, fieldname))
+        tf_d, _ = get_doc_tf(ix_reader, dn, fieldname, forward_index)
+        if tf_d is not None:
             docs_tfs[aId] = tf_d
         else:
             LOGGER.warning('No forward vector was found for docnum {}, articleID {}'.format(dn, aId))
@@ -88,34 +100,83 @@ def clarity(query: str, query_result_docs_tfs: defaultdict(lambda: defaultdict(i
     :param vocabulary: all distinct terms in the collection
     :return: a float number
     '''
-    query_terms = list(tokenize(query).keys())
-    if vocabulary is None:
-        vocabulary = query_terms
-
-    def get_prob_t_condition_Dq(t: str, lambd=0.9) -> float:
-        prob_t_condit_D = collection_tfs[t] / collection_total_terms
-        prob_term_condit_doc = lambda term, tfd: lambd * (tfd[term] / sum(tfd.values())) + \
-                                                         (1 - lambd) * prob_t_condit_D
-        norm = 0.00000001
-        for tf_d in query_result_docs_tfs.values():
-            norm += reduce(lambda x, y: x*y, map(lambda x: prob_term_condit_doc(x, tf_d), query_terms))
-        prob = 0.0
-        for tf_d in query_result_docs_tfs.values():
-            # tot_d = sum(tf_d.values())
-            prob_t_condit_d = prob_term_condit_doc(t, tf_d)
-            prob_q_condit_d = reduce(lambda x, y: x*y, map(lambda x: prob_term_condit_doc(x, tf_d), query_terms))
-            prob_d_condit_q = prob_q_condit_d / norm
-            prob += prob_t_condit_d * prob_d_condit_q
-        return prob
-
-    clt = 0.0
-    for t in vocabulary:
-        if collection_tfs[t] == 0:
-            collection_tfs[t] = 1
-        prob_t_condit_D = collection_tfs[t] / collection_total_terms
-        prob_t_condit_Dq = get_prob_t_condition_Dq(t)
-        clt += prob_t_condit_Dq * log(prob_t_condit_Dq / prob_t_condit_D)
-    return clt
+    return ClarityScorer(collection_tfs, collection_total_terms, vocabulary).clarity(query, query_result_docs_tfs)
+
+
+class ClarityScorer(object):
+    """Clarity of many queries against one collection.
+    Cronen-Townsend, Steve, Yun Zhou, and W. Bruce Croft. "Predicting query performance."
+    Proceedings of the 25th annual international ACM SIGIR conference. ACM, 2002.
+
+        clarity = sum_t P(t|Q) log(P(t|Q) / P(t|C))
+        P(t|Q) = sum_d P(t|d) P(d|Q),  P(x|d) = lambd tf(x,d)/|d| + (1-lambd) P(t|C),  P(d|Q) ~ prod_q P(q|d)
+
+    As in the original scorer, the query terms q are smoothed with P(t|C) of the term t being scored, so P(Q|d)
+    is a polynomial in P(t|C) of the degree of the query. Its coefficients are computed once per query, and
+    P(t|Q) of the whole vocabulary is one sparse accumulation over the result documents plus dense polynomial
+    evaluations. P(t|C) of the vocabulary is computed once; terms with no occurrence in the collection are
+    counted once."""
+
+    def __init__(self, collection_tfs: dict, collection_total_terms: int, vocabulary: list=None, lambd=0.9):
+        self._collection_tfs = collection_tfs
+        self._collection_total_terms = collection_total_terms
+        self.lambd = lambd
+        self._vocabulary = None
+        if vocabulary is not None:
+            self._set_vocabulary(vocabulary)
+
+    def _set_vocabulary(self, vocabulary: list):
+        self._vocabulary = {t: i for i, t in enumerate(vocabulary)}
+        self._prob_t_condit_D = self._collection_probabilities(vocabulary)
+
+    def _collection_probabilities(self, terms) -> np.ndarray:
+        tfs = np.fromiter((self._collection_tfs.get(t, 0) for t in terms), dtype=np.float64, count=len(terms))
+        return np.maximum(tfs, 1) / self._collection_total_terms
+
+    def clarity(self, query: str, query_result_docs_tfs: dict) -> float:
+        query_terms = list(tokenize(query).keys())
+        if self._vocabulary is None:
+            scorer = ClarityScorer(self._collection_tfs, self._collection_total_terms, query_terms, self.lambd)
+            return scorer.clarity(query, query_result_docs_tfs)
+        lambd = self.lambd
+        docs_tfs = list(query_result_docs_tfs.values())
+
+        # P(Q|d) = prod_q (lambd tf(q,d)/|d| + (1-lambd) c) with c = P(t|C): its coefficients (docs x degree + 1,
+        # highest degree first) are computed once per query
+        doc_lengths = np.array([sum(tf_d.values()) for tf_d in docs_tfs], dtype=np.float64)
+        doc_lengths[doc_lengths == 0] = np.inf
+        query_tfs = np.array([[tf_d.get(q, 0) for q in query_terms] for tf_d in docs_tfs],
+                             dtype=np.float64).reshape(len(docs_tfs), len(query_terms))
+        prob_q_condit_d = lambd * query_tfs / doc_lengths[:, None]
+        coefficients = np.ones((len(docs_tfs), 1))
+        for j in range(len(query_terms)):
+            coefficients = np.hstack([coefficients * (1 - lambd), np.zeros((len(docs_tfs), 1))]) + \
+                np.hstack([np.zeros((len(docs_tfs), 1)), coefficients * prob_q_condit_d[:, j:j + 1]])
+
+        # sum_d P(t|d) P(Q|d): the document part only touches the terms of the documents
+        get_id = self._vocabulary.get
+        docs, ids, weights = [], [], []
+        for d, (tf_d, l) in enumerate(zip(docs_tfs, doc_lengths)):
+            for t, f in tf_d.items():
+                i = get_id(t)
+                if i is not None:
+                    docs.append(d)
+                    ids.append(i)
+                    weights.append(f / l)
+        docs, ids = np.array(docs, dtype=np.int64), np.array(ids, dtype=np.int64)
+        prob_t_condit_D = self._prob_t_condit_D
+        c = prob_t_condit_D[ids]
+        prob_Q_condit_d = np.zeros(len(ids))
+        for k in range(coefficients.shape[1]):
+            prob_Q_condit_d = prob_Q_condit_d * c + coefficients[docs, k]
+        # sum_d P(Q|d) over the vocabulary
+        prob_Q = np.polyval(coefficients.sum(axis=0), prob_t_condit_D)
+        prob_t_condit_Dq = ((1 - lambd) * prob_t_condit_D * prob_Q +
+                            lambd * np.bincount(ids, weights=np.array(weights) * prob_Q_condit_d,
+                                                minlength=len(prob_t_condit_D))) / (0.00000001 + prob_Q)
+        nonzero = prob_t_condit_Dq > 0
+        return float(np.sum(prob_t_condit_Dq[nonzero] *
+                            np.log(prob_t_condit_Dq[nonzero] / prob_t_condit_D[nonzero])))
 
 
 if __name__ == '__main__':
@@ -129,6 +190,8 @@ if __name__ == '__main__':
     ix = index.open_dir(index_path, readonly=True)
     LOGGER.info('Index path: ' + index_path)
     ix_reader = ix.reader()
+    forward_index = ForwardIndex.open(ix)
+    article_docnums = ArticleDocnumIndex.open(ix, ix_reader)
 
     vocabulary = []
     db_tfs = defaultdict(int)
@@ -140,6 +203,8 @@ if __name__ == '__main__':
             db_total_terms += int(parts[1])
             vocabulary.append(parts[0])
 
+    clarity_scorer = ClarityScorer(db_tfs, db_total_terms, vocabulary)
+
     df = pd.read_csv(query_file_path)
     df.drop_duplicates(subset='id', inplace=True)
     for q in df['query']:
@@ -148,8 +213,8 @@ if __name__ == '__main__':
         scs = specificity(q, db_tfs, db_total_terms)
 
         aids = list(map(lambda x: str(x), qdf['articleId'].values))
-        docs_tfs = get_docs_tfs(aids, ix_reader)
-        clt = clarity(q, docs_tfs, db_tfs, db_total_terms)
+        docs_tfs = get_docs_tfs(aids, ix_reader, forward_index=forward_index, article_docnums=article_docnums)
+        clt = clarity_scorer.clarity(q, docs_tfs)
 
         df.loc[qdf.index, 'specificity'] = scs
         df.loc[qdf.index, 'clarity'] = clt
@@ -0,0 +1,72 @@
+from collections import OrderedDict, Counter
+import logging
+
+LOGGER = logging.getLogger()
+
+
+class ResultCache(object):
+    """LRU cache of search results, bounded by a number of entries and a total number of cached documents.
+    Keys are tuples that start with an owner token (e.g. a partition) followed by whatever identifies the
+    result: (owner, generation, normalized query, sort mode, ...). An owner bumps its generation whenever its
+    content changes, so stale entries are never hit again, and invalidate(owner) frees them right away."""
+
+    def __init__(self, max_entries: int=1024, max_docs: int=5000000):
+        self.max_entries = max_entries
+        self.max_docs = max_docs
+        self._entries = OrderedDict()
+        self._owners = Counter()
+        self._docs = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """the cached (docs, items) of the key, or None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, docs: set, items: list):
+        if len(items) > self.max_docs:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (docs, items)
+        self._owners[key[0]] += 1
+        self._docs += len(items)
+        while len(self._entries) > self.max_entries or self._docs > self.max_docs:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, items = self._entries.pop(key)
+        self._docs -= len(items)
+        self._owners[key[0]] -= 1
+        if self._owners[key[0]] == 0:
+            del self._owners[key[0]]
+
+    def invalidate(self, owner):
+        """drops every entry of the owner"""
+        if self._owners.get(owner, 0) == 0:
+            return
+        for key in [k for k in self._entries if k[0] == owner]:
+            self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._owners.clear()
+        self._docs = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'docs': self._docs,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0}
+
+
+# shared by default by all the partitions and search.search of a process
+SHARED_CACHE = ResultCache()
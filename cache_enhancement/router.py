@@ -0,0 +1,164 @@
+import whoosh.index as index
+from whoosh.qparser import QueryParser
+from whoosh import sorting
+from collections import defaultdict
+from partition import IndexVirtualPartition
+import querydifficulty as qd
+import config
+import logging
+import time
+import sys
+
+LOGGER = logging.getLogger()
+
+
+class TieredRouter(object):
+    """Searches a materialized cache index (build.build_partition_index) first and falls back to the full index
+    when the cache has fewer than min_hits results. Latencies are kept for each tier."""
+
+    def __init__(self, cache_ix: index.FileIndex, full_ix: index.FileIndex, fieldname: str='body',
+                 min_hits: int=1):
+        self.fieldname = fieldname
+        self.min_hits = min_hits
+        self._searchers = {'cache': cache_ix.searcher(), 'full': full_ix.searcher()}
+        self._parser = QueryParser(fieldname, full_ix.schema)
+        self.queries = defaultdict(int)
+        self.latencies = defaultdict(float)
+
+    def close(self):
+        for searcher in self._searchers.values():
+            searcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _search(self, tier: str, query, limit: int, sorted_by_count: bool) -> tuple:
+        st = time.perf_counter()
+        skw = {'limit': limit}
+        if sorted_by_count:
+            skw['sortedby'] = sorting.FieldFacet('count', reverse=True)
+        results = self._searchers[tier].search(query, **skw)
+        hits = [(res.fields(), res.score) for res in results]
+        elapsed = time.perf_counter() - st
+        self.latencies[tier] += elapsed
+        return hits, elapsed
+
+    def search(self, text: str, limit: int=10, sorted_by_count=False) -> tuple:
+        """(tier, hits): the tier ('cache' or 'full') that answered and its hits as (stored fields, score)"""
+        query = self._parser.parse(text)
+        hits, cache_time = self._search('cache', query, limit, sorted_by_count)
+        tier, full_time = 'cache', 0.0
+        if len(hits) < self.min_hits:
+            tier = 'full'
+            hits, full_time = self._search('full', query, limit, sorted_by_count)
+        self.queries[tier] += 1
+        LOGGER.info('Query [{}]: {} ({} hits), cache {:.2f}ms, full {:.2f}ms'
+                    .format(text, tier, len(hits), cache_time * 1000, full_time * 1000))
+        return tier, hits
+
+    def stats(self) -> dict:
+        queries = sum(self.queries.values())
+        return {'queries': queries, 'cache_answered': self.queries['cache'], 'full_answered': self.queries['full'],
+                'cache_latency': self.latencies['cache'], 'full_latency': self.latencies['full'],
+                'hit_rate': self.queries['cache'] / queries if queries > 0 else 0.0}
+
+
+class SignalRouter(object):
+    """Routes queries over a (cache, disk) pair of partitions of the same index. Pre-retrieval signals decide
+    whether the cache alone is good enough: every query term occurs in the cache, the query is at most
+    max_specificity_gap more specific (querydifficulty.specificity) to the cache than to the disk, and the
+    similarity (querydifficulty.similarity) of the cache is at least min_similarity_ratio of the disk's.
+    Similarities grow with the counts of a partition, so both are divided by the total terms of their partition
+    and a cache as dense in the query terms as the disk has a ratio around 1 whatever its size.
+    The disk is only searched when the signals say otherwise or the cache has fewer than min_hits results;
+    results of both are then merged by score, which is comparable as both are scored by the searcher of the index.
+    To calibrate the thresholds, log signals() of a sample of queries and pick the quantiles of the similarity
+    ratio and of the specificity gap that give the share of queries the cache should answer on its own."""
+
+    def __init__(self, cache: IndexVirtualPartition, disk: IndexVirtualPartition, max_specificity_gap: float=0.25,
+                 min_similarity_ratio: float=0.5, min_hits: int=1, similarity_mode: str='avg'):
+        self.cache = cache
+        self.disk = disk
+        self.max_specificity_gap = max_specificity_gap
+        self.min_similarity_ratio = min_similarity_ratio
+        self.min_hits = min_hits
+        self.similarity_mode = similarity_mode
+        self.queries = defaultdict(int)
+        self.latencies = defaultdict(float)
+
+    def signals(self, text: str) -> dict:
+        """the signals of the query on both partitions, and whether they send it to the cache only"""
+        terms = list(qd.tokenize(text).keys())
+        signals = {'terms': len(terms), 'missing_terms': sum(1 for t in terms if self.cache.get_tfs()[t] == 0)}
+        if len(terms) == 0 or signals['missing_terms'] > 0:
+            signals['cache_only'] = False
+            return signals
+        for name, part in (('cache', self.cache), ('disk', self.disk)):
+            signals[name + '_specificity'] = qd.specificity(text, part.get_tfs(), part.get_total_terms())
+            # similarity takes the log of the tf of every term
+            signals[name + '_similarity'] = qd.similarity(text, part, self.similarity_mode) / part.get_total_terms() \
+                if all(part.get_tfs()[t] > 0 for t in terms) else 0.0
+        signals['specificity_gap'] = signals['cache_specificity'] - signals['disk_specificity']
+        signals['similarity_ratio'] = signals['cache_similarity'] / signals['disk_similarity'] \
+            if signals['disk_similarity'] > 0 else float('inf')
+        signals['cache_only'] = signals['specificity_gap'] <= self.max_specificity_gap and \
+            signals['similarity_ratio'] >= self.min_similarity_ratio
+        return signals
+
+    def _search(self, tier: str, partition: IndexVirtualPartition, text: str, limit: int) -> list:
+        st = time.perf_counter()
+        _, items = partition.search(text, limit=limit)
+        items = list(items)
+        self.latencies[tier] += time.perf_counter() - st
+        return items
+
+    def search(self, text: str, limit: int=10) -> tuple:
+        """(tiers, items): the tiers that were searched ('cache', 'disk' or 'cache+disk') and the (docnum, score)
+        of the results from the highest score"""
+        st = time.perf_counter()
+        signals = self.signals(text)
+        self.latencies['signals'] += time.perf_counter() - st
+        items = []
+        # the cache is not searched when it has none of the terms
+        cache_searched = signals['terms'] == 0 or signals['missing_terms'] < signals['terms']
+        if cache_searched:
+            items = self._search('cache', self.cache, text, limit)
+        if signals['cache_only'] and len(items) >= self.min_hits:
+            tiers = 'cache'
+        else:
+            tiers = 'cache+disk' if cache_searched else 'disk'
+            seen = set(dn for dn, _ in items)
+            items += [(dn, score) for dn, score in self._search('disk', self.disk, text, limit) if dn not in seen]
+            items.sort(key=lambda item: item[1], reverse=True)
+            items = items[:limit] if limit is not None else items
+        self.queries[tiers] += 1
+        elapsed = time.perf_counter() - st
+        self.latencies['total'] += elapsed
+        LOGGER.info('Query [{}]: {} ({} hits) in {:.2f}ms, signals {}'
+                    .format(text, tiers, len(items), elapsed * 1000, signals))
+        return tiers, items
+
+    def stats(self) -> dict:
+        queries = sum(self.queries.values())
+        stats = {'queries': queries, 'hit_rate': self.queries['cache'] / queries if queries > 0 else 0.0}
+        stats.update(('{}_answered'.format(t), n) for t, n in self.queries.items())
+        stats.update(('{}_latency'.format(t), v) for t, v in self.latencies.items())
+        return stats
+
+
+if __name__ == '__main__':
+    configuration = config.get_paths()
+    cache_index_name, full_index_name = sys.argv[1], sys.argv[2]
+    with TieredRouter(index.open_dir(configuration[cache_index_name], readonly=True),
+                      index.open_dir(configuration[full_index_name], readonly=True)) as router:
+        user_query = input('Query [:q to exit] : ')
+        while user_query != ':q':
+            tier, hits = router.search(user_query)
+            print('{} results from {}'.format(len(hits), tier))
+            for fields, score in hits:
+                print('<Hit {!r}> {:.4f}'.format(fields, score))
+            user_query = input('Query [:q to exit] : ')
+        print(router.stats())
@@ -1,22 +1,35 @@
 import whoosh.index as index
 from whoosh.qparser import QueryParser
 from whoosh import sorting
+from resultcache import ResultCache, SHARED_CACHE
 import config
 import sys
 
 
-def search(user_query: str, limit: int, index_dir_path: str, field_name="body"):
+def search(user_query: str, limit: int, index_dir_path: str, field_name="body",
+           result_cache: ResultCache=SHARED_CACHE):
     ix = index.open_dir(index_dir_path, readonly=True)
     print('Results for query [{}] in directory [{}]'.format(user_query, index_dir_path))
     with ix.searcher() as searcher:
         query = QueryParser(field_name, ix.schema).parse(user_query)
-        facet = sorting.FieldFacet('count', reverse=True)
-        results = searcher.search(query, sortedby=facet, limit=limit)
-        print(results)
-        for res in results:
-            print('\n', res)
-            if res.reader.has_vector(res.docnum, field_name):
-                vgen = res.reader.vector_as('frequency', res.docnum, field_name)
+        # cached hits are (docnum, stored fields); keyed by index generation so a changed index is not hit
+        cache_key = (index_dir_path, ix.latest_generation(), query.normalize(), 'count', limit)
+        cached = result_cache.get(cache_key) if result_cache is not None else None
+        if cached is None:
+            facet = sorting.FieldFacet('count', reverse=True)
+            results = searcher.search(query, sortedby=facet, limit=limit)
+            print(results)
+            hits = [(res.docnum, res.fields()) for res in results]
+            if result_cache is not None:
+                result_cache.put(cache_key, set(dn for dn, _ in hits), hits)
+        else:
+            hits = cached[1]
+            print('<Top {} cached results for {!r}>'.format(len(hits), query))
+        reader = searcher.reader()
+        for docnum, fields in hits:
+            print('\n', '<Hit {!r}>'.format(fields))
+            if reader.has_vector(docnum, field_name):
+                vgen = reader.vector_as('frequency', docnum, field_name)
                 terms = [v for v in vgen]
                 terms.sort(key=lambda tup: tup[1], reverse=True)
                 print('Top terms: ', terms)
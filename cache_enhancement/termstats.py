@@ -0,0 +1,119 @@
+from collections.abc import Mapping
+import numpy as np
+import logging
+
+LOGGER = logging.getLogger()
+
+
+class TermVocabulary(object):
+    """Global term <-> term-id mapping of an indexed field.
+    Term ids are the positions of the terms in the (sorted) term list, so every partition built on the same
+    vocabulary can keep its statistics in plain count vectors aligned by term id."""
+
+    def __init__(self, terms: list):
+        self._terms = terms
+        self._ids = {t: i for i, t in enumerate(terms)}
+        self._doc_frequencies = {}
+
+    @classmethod
+    def from_reader(cls, ix_reader, fieldname='body'):
+        LOGGER.info('Building vocabulary of [{}] field of the Index'.format(fieldname))
+        return cls(list(ix_reader.field_terms(fieldname)))
+
+    def __len__(self):
+        return len(self._terms)
+
+    def __contains__(self, term):
+        return term in self._ids
+
+    def id(self, term, default=-1) -> int:
+        return self._ids.get(term, default)
+
+    def ids(self, terms) -> np.ndarray:
+        """term ids of the given terms; -1 for the terms that are not in the vocabulary"""
+        get = self._ids.get
+        return np.fromiter((get(t, -1) for t in terms), dtype=np.int64)
+
+    def term(self, term_id: int) -> str:
+        return self._terms[term_id]
+
+    def terms(self) -> list:
+        return self._terms
+
+    def doc_frequencies(self, ix_reader, fieldname='body') -> np.ndarray:
+        """Index-wide document frequency of every term, read in one pass over the term dictionary and cached"""
+        if fieldname not in self._doc_frequencies:
+            LOGGER.info('Reading doc frequencies of [{}] field of the Index'.format(fieldname))
+            dfs = np.zeros(len(self._terms), dtype=np.int64)
+            from_bytes = ix_reader.schema[fieldname].from_bytes
+            for text, terminfo in ix_reader.iter_field(fieldname):
+                i = self._ids.get(from_bytes(text), -1)
+                if i >= 0:
+                    dfs[i] = terminfo.doc_frequency()
+            self._doc_frequencies[fieldname] = dfs
+        return self._doc_frequencies[fieldname]
+
+
+class TermCountView(Mapping):
+    """Read-only, dict-like view over a count vector indexed by term id.
+    Terms with zero count are not listed, and reading a missing term gives 0 (like a defaultdict(int))."""
+
+    def __init__(self, vocabulary: TermVocabulary, counts: np.ndarray):
+        self._vocabulary = vocabulary
+        self._counts = counts
+
+    def __getitem__(self, term):
+        i = self._vocabulary.id(term)
+        return self._counts[i].item() if i >= 0 else 0
+
+    def get(self, term, default=None):
+        i = self._vocabulary.id(term)
+        if i < 0 or self._counts[i] == 0:
+            return default
+        return self._counts[i].item()
+
+    def __contains__(self, term):
+        i = self._vocabulary.id(term)
+        return i >= 0 and self._counts[i] != 0
+
+    def __iter__(self):
+        terms = self._vocabulary.terms()
+        for i in np.flatnonzero(self._counts):
+            yield terms[i]
+
+    def __len__(self):
+        return int(np.count_nonzero(self._counts))
+
+    def ids(self) -> np.ndarray:
+        """term ids with a non-zero count"""
+        return np.flatnonzero(self._counts)
+
+    def counts(self) -> np.ndarray:
+        """the underlying count vector, aligned with the vocabulary term ids"""
+        return self._counts
+
+    def measure(self, ids) -> np.ndarray:
+        """values of the terms with the given ids"""
+        return self._counts[ids]
+
+
+class TermScoreView(TermCountView):
+    """Read-only, dict-like view of a score computed on demand from term ids by score_fn.
+    It lists the terms with a non-zero count, and reading any other term gives 0.0."""
+
+    def __init__(self, vocabulary: TermVocabulary, counts: np.ndarray, score_fn):
+        super(TermScoreView, self).__init__(vocabulary, counts)
+        self._score_fn = score_fn
+
+    def __getitem__(self, term):
+        i = self._vocabulary.id(term)
+        return self._score_fn(np.array([i]))[0].item() if i >= 0 and self._counts[i] != 0 else 0.0
+
+    def get(self, term, default=None):
+        i = self._vocabulary.id(term)
+        if i < 0 or self._counts[i] == 0:
+            return default
+        return self._score_fn(np.array([i]))[0].item()
+
+    def measure(self, ids) -> np.ndarray:
+        return self._score_fn(np.asarray(ids))
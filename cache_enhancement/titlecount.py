@@ -0,0 +1,120 @@
+from array import array
+import numpy as np
+import config
+import logging
+import codecs
+import shutil
+import json
+import time
+import os
+
+LOGGER = logging.getLogger()
+
+# the key of the lines without an article ID, which config.get_article_id_from_file_name gives as -1;
+# no article ID string encodes to it
+_NO_ID = b'\xff'
+# bumped when the files of a compiled table change
+_TABLE_FORMAT = 2
+
+
+class TitleCountTable(object):
+    """Read-only articleID -> {'title': .., 'count': ..} lookup over a compiled page-count file.
+    Article IDs are kept as their exact utf-8 strings, sorted in a memory-mapped array (binary search), and titles
+    are slices of one utf-8 buffer, so opening the table costs no parsing and almost no memory.
+    It answers `did in table` and `table[did]` like the dict of config.build_wiki13_title_count."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+        self._counts = np.load(os.path.join(path, 'counts.npy'), mmap_mode='r')
+        self._title_starts = np.load(os.path.join(path, 'title_starts.npy'), mmap_mode='r')
+        self._title_ends = np.load(os.path.join(path, 'title_ends.npy'), mmap_mode='r')
+        titles_path = os.path.join(path, 'titles.bin')
+        self._titles = np.memmap(titles_path, dtype=np.uint8, mode='r') if os.path.getsize(titles_path) > 0 \
+            else np.zeros(0, dtype=np.uint8)
+
+    def _find(self, article_id) -> int:
+        if isinstance(article_id, str):
+            key = article_id.encode('utf-8')
+        elif article_id == -1:
+            key = _NO_ID
+        else:
+            return -1
+        if len(self._ids) == 0 or len(key) > self._ids.dtype.itemsize:
+            return -1
+        i = int(np.searchsorted(self._ids, key))
+        return i if i < len(self._ids) and self._ids[i] == key else -1
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, article_id):
+        return self._find(article_id) >= 0
+
+    def __getitem__(self, article_id) -> dict:
+        i = self._find(article_id)
+        if i < 0:
+            raise KeyError(article_id)
+        title = self._titles[self._title_starts[i]:self._title_ends[i]].tobytes().decode('utf-8')
+        return {'title': title, 'count': int(self._counts[i])}
+
+
+def _source_signature(csv_path: str) -> dict:
+    st = os.stat(csv_path)
+    return {'source': os.path.abspath(csv_path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+            'format': _TABLE_FORMAT}
+
+
+def compile_table(csv_path: str, table_path: str) -> TitleCountTable:
+    """Streams the page-count CSV into a TitleCountTable; for repeated IDs the last line wins as in the dict"""
+    st = time.time()
+    LOGGER.info('Compiling title-count table of {} to {}'.format(csv_path, table_path))
+    tmp_path = table_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    ids, counts, title_starts, title_ends = [], array('q'), array('q'), array('q')
+    offset = 0
+    with codecs.open(csv_path, 'r', encoding='utf-8') as fo, \
+            open(os.path.join(tmp_path, 'titles.bin'), 'wb') as fw:
+        for l in fo:
+            artic_id, artic_count, artic_title = config.parse_wiki13_title_count_line(l)
+            if artic_id == -1:
+                LOGGER.warning('No article ID in title-count line {}'.format(l.strip()))
+            title = artic_title.encode('utf-8')
+            fw.write(title)
+            ids.append(artic_id.encode('utf-8') if artic_id != -1 else _NO_ID)
+            counts.append(artic_count)
+            title_starts.append(offset)
+            offset += len(title)
+            title_ends.append(offset)
+    ids = np.array(ids, dtype=bytes) if len(ids) > 0 else np.zeros(0, dtype='S1')
+    order = np.argsort(ids, kind='mergesort')
+    sorted_ids = ids[order]
+    # stable sort keeps repeated IDs in file order; keep the last one
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = sorted_ids[:-1] != sorted_ids[1:]
+    order = order[last]
+    np.save(os.path.join(tmp_path, 'ids.npy'), sorted_ids[last])
+    np.save(os.path.join(tmp_path, 'counts.npy'), np.frombuffer(counts, dtype=np.int64)[order])
+    np.save(os.path.join(tmp_path, 'title_starts.npy'), np.frombuffer(title_starts, dtype=np.int64)[order])
+    np.save(os.path.join(tmp_path, 'title_ends.npy'), np.frombuffer(title_ends, dtype=np.int64)[order])
+    # meta.json is written last; a table without it is incomplete
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as fw:
+        json.dump(_source_signature(csv_path), fw)
+    if os.path.exists(table_path):
+        shutil.rmtree(table_path)
+    os.rename(tmp_path, table_path)
+    LOGGER.info('Title-count table of {} articles compiled. [{:.1f}s]'.format(len(order), time.time() - st))
+    return TitleCountTable(table_path)
+
+
+def open_table(csv_path: str) -> TitleCountTable:
+    """The compiled table of a page-count CSV (kept next to it); compiled again only if the CSV changed"""
+    table_path = csv_path + '.table'
+    meta_path = os.path.join(table_path, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as fo:
+            if json.load(fo) == _source_signature(csv_path):
+                return TitleCountTable(table_path)
+    return compile_table(csv_path, table_path)